@@ -1,57 +1,150 @@
 import subprocess
+import os
 import sys
 import csv
-from urllib.parse import urlparse
-from github_api_manager import github_api
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, parse_qs
+from github_api_manager import github_api, GitHubAPIError
 
-def get_repos(user_or_org):
-    path = urlparse(user_or_org).path.strip("/")
-    url = f"https://api.github.com/users/{path}/repos"
-    repos = []
-    page = 1
-    
+# Number of git ls-remote calls running at the same time, and timeout of each call in seconds
+WORKERS = 32
+LS_REMOTE_TIMEOUT = 60
+# Rounds of requests for a listing page before giving up, and first delay between them in seconds (then doubled)
+PAGE_ATTEMPTS = 3
+PAGE_RETRY_DELAY = 5
+
+def last_page_number(links):
+    # Number of the last page announced by the Link header, 1 when there is a single page
+    if "last" not in links:
+        return 1
+    return int(parse_qs(urlparse(links["last"]).query)["page"][0])
+
+def get_first_page(url, params):
+    # First page of the listing and its pagination links, asked again after a server or connection error
+    attempt = 0
     while True:
-        data = github_api.make_request(url, params={"per_page": 100, "page": page})
-        if not data or "message" in data:
+        try:
+            return github_api.make_request_with_links(url, params={**params, "page": 1}, raise_errors=True)
+        except GitHubAPIError as e:
+            attempt += 1
+            # A user or organization that does not exist will not appear by asking again
+            if attempt == PAGE_ATTEMPTS or (e.status_code is not None and e.status_code < 500):
+                raise
+            time.sleep(PAGE_RETRY_DELAY * 2 ** (attempt - 1))
+
+def get_pages(url, params, pages):
+    # Pages of the listing fetched in parallel, then the failed ones again, at most PAGE_ATTEMPTS times
+    fetched = {}
+    missing = list(pages)
+    for attempt in range(PAGE_ATTEMPTS):
+        if attempt:
+            print(f"Fetching {len(missing)} pages of {url} again")
+            time.sleep(PAGE_RETRY_DELAY * 2 ** (attempt - 1))
+        pages_data = github_api.make_requests([url] * len(missing), [{**params, "page": page} for page in missing])
+        for page, data in zip(missing, pages_data):
+            if isinstance(data, list):
+                fetched[page] = data
+        missing = [page for page in missing if page not in fetched]
+        if not missing:
             break
+    else:
+        raise GitHubAPIError(f"Could not fetch pages {', '.join(map(str, missing))} of {url}")
+
+    return [fetched[page] for page in pages]
+
+def get_repos(user_or_org, endpoint="users", repo_type=None, sort=None, exclude_archived=False, exclude_forks=False):
+    path = urlparse(user_or_org).path.strip("/")
+    url = f"https://api.github.com/{endpoint}/{path}/repos"
+    params = {"per_page": 100}
+    if repo_type:
+        params["type"] = repo_type
+    if sort:
+        params["sort"] = sort
+
+    # The first page tells how many pages there are, the others are then fetched in parallel
+    # A page that cannot be fetched raises GitHubAPIError, whole pages of repositories are never left out
+    data, links = get_first_page(url, params)
+    repos = list(data)
+
+    for data in get_pages(url, params, range(2, last_page_number(links) + 1)):
         repos.extend(data)
-        page += 1
-    
+
+    if exclude_archived:
+        repos = [repo for repo in repos if not repo.get("archived")]
+    if exclude_forks:
+        repos = [repo for repo in repos if not repo.get("fork")]
+
     return repos
 
-def check_clonable(clone_url):
+def check_clonable(clone_url, timeout=LS_REMOTE_TIMEOUT):
     try:
         subprocess.run(
             ["git", "ls-remote", clone_url],
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
             check=True,
+            timeout=timeout,
+            # Never wait for credentials on a private or deleted repository
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
         )
         return True
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
         return False
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python 1_check_repos.py <GitHub user/org URL> --out [output CSV filename]")
-        sys.exit(1)
-    
-    url = sys.argv[1]
-    output_csv = sys.argv[3] if len(sys.argv) >= 3 else "repos.csv"
+def check_repos(repos, writer, workers=WORKERS, timeout=LS_REMOTE_TIMEOUT):
+    # Repos are checked concurrently, rows are written as soon as every previous repo is done
+    results = {}
+    next_index = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(check_clonable, repo["clone_url"], timeout): index
+            for index, repo in enumerate(repos)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            results[index] = future.result()
+
+            name = repos[index]["name"]
+            status = "clonable" if results[index] else "not clonable"
+            print(f"[{done}/{len(repos)}] {name}: {status}")
+
+            while next_index in results:
+                if results.pop(next_index):
+                    writer.writerow([repos[next_index]["name"], repos[next_index]["clone_url"]])
+                next_index += 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the clonable repositories of a GitHub user/org")
+    parser.add_argument("url", help="GitHub user/org URL")
+    parser.add_argument("--out", dest="output_csv", default="repos.csv",
+                        help="Output CSV filename (default: repos.csv)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help=f"Number of repositories checked at the same time (default: {WORKERS})")
+    parser.add_argument("--timeout", type=int, default=LS_REMOTE_TIMEOUT,
+                        help=f"Seconds before a git ls-remote call is abandoned (default: {LS_REMOTE_TIMEOUT})")
+    parser.add_argument("--orgs", action="store_true",
+                        help="List the repositories with the /orgs/ endpoint instead of /users/")
+    parser.add_argument("--type", dest="repo_type", default=None,
+                        help="Type of repositories to list, e.g. all, sources, forks (server-side filter)")
+    parser.add_argument("--sort", default=None,
+                        help="Sort order of the listing: created, updated, pushed or full_name")
+    parser.add_argument("--exclude-archived", action="store_true", help="Leave archived repositories out")
+    parser.add_argument("--exclude-forks", action="store_true", help="Leave forked repositories out")
+    args = parser.parse_args(argv)
     
-    repos = get_repos(url)
+    try:
+        repos = get_repos(args.url, "orgs" if args.orgs else "users", args.repo_type, args.sort,
+                          args.exclude_archived, args.exclude_forks)
+    except GitHubAPIError as e:
+        print(f"Could not list the repositories of {args.url}: {e}")
+        sys.exit(1)
     
-    with open(output_csv, "w", newline="", encoding="utf-8") as f:
+    with open(args.output_csv, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
         writer.writerow(["name", "clone_url"])
-        
-        for repo in repos:
-            name = repo["name"]
-            clone_url = repo["clone_url"]
-            clonable = check_clonable(clone_url)
-            
-            if clonable:
-                writer.writerow([name, clone_url])
-            
-            status = "clonable" if clonable else "not clonable"
-            print(f"{name}: {status}")
\ No newline at end of file
+        check_repos(repos, writer, args.workers, args.timeout)
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,69 @@ import tempfile
 import shutil
 import time
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from github_api_manager import github_api
 
 IAC_EXTENSIONS = {".pp"}
+# Percentage of IaC files needed for a repository to be kept
+MIN_IAC_RATIO = 11
+
+# Number of repositories processed at the same time, and number of them allowed to clone at once
+WORKERS = 16
+MAX_CLONES = 8
+# Free space kept in the temp directory, clones wait for it below this threshold
+MIN_FREE_TEMP_MB = 1024
+# First retry delay in seconds, doubled after every failed attempt
+RETRY_DELAY = 5
+# Attempts of a clone before the repository is given up: retried after 5s, 10s then 20s
+CLONE_ATTEMPTS = 4
+# Clones failing in a row, across all the workers, before every new clone backs off
+BACKOFF_AFTER_FAILURES = 3
+# Longest wait of that backoff, in seconds
+MAX_BACKOFF = 300
+
+class CloneSlots:
+    """
+    Limits the clones running at the same time and the space they take in the temp directory.
+    A clone raising a subprocess error inside its slot is a failure: once BACKOFF_AFTER_FAILURES clones
+    failed in a row, across all the workers, every new clone first waits RETRY_DELAY, twice as long after
+    every further failure, until a clone succeeds again.
+    """
+    def __init__(self, max_clones=MAX_CLONES, tmp_dir=None, min_free_mb=MIN_FREE_TEMP_MB):
+        self._semaphore = threading.BoundedSemaphore(max_clones)
+        self.tmp_dir = tmp_dir or tempfile.gettempdir()
+        self.min_free = min_free_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._failures = 0
+
+    def backoff(self):
+        # Seconds a new clone waits while failures pile up, 0 when the last clones succeeded
+        with self._lock:
+            failures = self._failures
+        if failures < BACKOFF_AFTER_FAILURES:
+            return 0
+        return min(RETRY_DELAY * 2 ** (failures - BACKOFF_AFTER_FAILURES), MAX_BACKOFF)
+
+    def __enter__(self):
+        delay = self.backoff()
+        if delay:
+            print(f"Clones keep failing, waiting {delay}s before the next one")
+            time.sleep(delay)
+        self._semaphore.acquire()
+        while shutil.disk_usage(self.tmp_dir).free < self.min_free:
+            print(f"Less than {self.min_free // (1024 * 1024)} MB free in {self.tmp_dir}, waiting")
+            time.sleep(RETRY_DELAY)
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        with self._lock:
+            if exc_type is None:
+                self._failures = 0
+            elif issubclass(exc_type, subprocess.SubprocessError):
+                self._failures += 1
+        self._semaphore.release()
 
 def count_iac_files(repo_path):
     total_files = 0
@@ -23,73 +84,195 @@ def count_iac_files(repo_path):
     
     return total_files, iac_files
 
-def process_repo(clone_url, retries=2):
-    tmpdir = tempfile.mkdtemp()
+def count_tree_files(git_dir):
+    # Counts of the API backend read with git: every blob of the tree of HEAD, as the Git Trees API lists them
+    result = subprocess.run(["git", "--git-dir", git_dir, "ls-tree", "-r", "-z", "HEAD"],
+                            capture_output=True, check=True)
+    total_files = 0
+    iac_files = 0
+    for entry in result.stdout.split(b"\0"):
+        if not entry:
+            continue
+        info, path = entry.split(b"\t", 1)
+        if info.split()[1] != b"blob":
+            continue
+        total_files += 1
+        _, ext = os.path.splitext(path.decode("utf-8", errors="surrogateescape"))
+        if ext.lower() == ".pp":
+            iac_files += 1
+
+    return total_files, iac_files
+
+def count_iac_files_from_tree_clone(clone_url, tmp_dir):
+    # Counts of the API backend from a shallow clone without any blob, for the trees the API cannot return
+    # Raises subprocess.CalledProcessError when it fails
+    tmpdir = tempfile.mkdtemp(dir=tmp_dir)
     try:
-        attempt = 0
-        while attempt < retries:
-            try:
-                subprocess.run(
-                    ["git", "config", "--global", "http.postBuffer", "524288000"],
-                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                    check=True, text=True
-                )
-
-                subprocess.run(
-                    ["git", "init", "-b", "main"],
-                    cwd=tmpdir,
-                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                    check=True, text=True
-                )
-
-                subprocess.run(
-                    ["git", "remote", "add", "origin", clone_url],
-                    cwd=tmpdir,
-                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                    check=True, text=True
-                )
-
-                subprocess.run(
-                    ["git", "config", "core.sparseCheckout", "true"],
-                    cwd=tmpdir,
-                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                    check=True, text=True
-                )
-
-                sparse_file = os.path.join(tmpdir, ".git", "info", "sparse-checkout")
-                with open(sparse_file, "w") as f:
-                    f.write("*.pp\n")
-
-                subprocess.run(
-                    ["git", "pull", "--depth=1", "origin", "HEAD"],
-                    cwd=tmpdir,
-                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                    check=True, text=True
-                )
-                break
-
-            except subprocess.CalledProcessError:
-                attempt += 1
-                time.sleep(5)
-                if attempt == retries:
-                    return 0, 0, 0
-        
-        total, iac = count_iac_files(tmpdir)
-        ratio = (iac / total * 100) if total > 0 else 0
-        return total, iac, ratio
-    
+        subprocess.run(
+            ["git", "clone", "--bare", "--depth=1", "--filter=blob:none", clone_url, tmpdir],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            check=True, text=True,
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        )
+        return count_tree_files(tmpdir)
     finally:
         shutil.rmtree(tmpdir, ignore_errors=True)
 
+def count_iac_files_from_tree(clone_url):
+    # Counts from a single recursive Git Trees API call, None when the tree cannot be used
+    # Not the clone metric: the total is every file of the tree, where the clone also counts its .git files
+    parsed = urlparse(clone_url)
+    if parsed.netloc != "github.com":
+        return None
+    repo_path = parsed.path.strip("/")
+    if repo_path.endswith(".git"):
+        repo_path = repo_path[:-len(".git")]
 
-if __name__ == "__main__":
+    data = github_api.make_request(f"https://api.github.com/repos/{repo_path}/git/trees/HEAD",
+                                   params={"recursive": 1})
+    if not data or "tree" not in data or data.get("truncated"):
+        # Trees too large for a single response are only complete in a clone
+        return None
+
+    total_files = 0
+    iac_files = 0
+    for entry in data["tree"]:
+        if entry["type"] != "blob":
+            continue
+        total_files += 1
+        _, ext = os.path.splitext(entry["path"])
+        if ext.lower() == ".pp":
+            iac_files += 1
+
+    return total_files, iac_files
+
+def count_iac_files_from_clone(clone_url, tmp_dir):
+    # Counts from a sparse shallow clone of the .pp files, raises subprocess.CalledProcessError when it fails
+    tmpdir = tempfile.mkdtemp(dir=tmp_dir)
+    try:
+        subprocess.run(
+            ["git", "init", "-b", "main"],
+            cwd=tmpdir,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            check=True, text=True
+        )
+
+        subprocess.run(
+            ["git", "remote", "add", "origin", clone_url],
+            cwd=tmpdir,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            check=True, text=True
+        )
+
+        subprocess.run(
+            ["git", "config", "core.sparseCheckout", "true"],
+            cwd=tmpdir,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            check=True, text=True
+        )
+
+        sparse_file = os.path.join(tmpdir, ".git", "info", "sparse-checkout")
+        with open(sparse_file, "w") as f:
+            f.write("*.pp\n")
+
+        # Set for this command only: concurrent workers cannot share a write to the global config
+        subprocess.run(
+            ["git", "-c", "http.postBuffer=524288000", "pull", "--depth=1", "origin", "HEAD"],
+            cwd=tmpdir,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            check=True, text=True,
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        )
+
+        return count_iac_files(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def count_iac_files_with_retries(clone_url, clone_slots, retries=CLONE_ATTEMPTS, tree=False):
+    # Counts from the clone, or the counts of the API backend from a blobless clone with tree,
+    # None when every attempt failed
+    count = count_iac_files_from_tree_clone if tree else count_iac_files_from_clone
+    attempt = 0
+    while True:
+        try:
+            with clone_slots:
+                return count(clone_url, clone_slots.tmp_dir)
+        except subprocess.CalledProcessError:
+            attempt += 1
+            if attempt == retries:
+                return None
+            # Every attempt starts from a new directory, waiting longer after every failure without holding a slot
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+
+def process_repo(clone_url, retries=CLONE_ATTEMPTS, backend="clone", clone_slots=None):
+    # Counts and IaC ratio of a repository, (0, 0, 0) when it cannot be cloned
+    # Never read from a mirror: most repositories are discarded here, the next steps only mirror the kept ones
+    if backend == "api":
+        counts = count_iac_files_from_tree(clone_url)
+        if counts is not None:
+            total, iac = counts
+            ratio = (iac / total * 100) if total > 0 else 0
+            return total, iac, ratio
+        # The API metric is kept, so a single run never mixes the two ratios
+        print(f"Tree of {clone_url} not available from the API, listing it from a clone")
+
+    if clone_slots is None:
+        clone_slots = CloneSlots()
+
+    counts = count_iac_files_with_retries(clone_url, clone_slots, retries, tree=backend == "api")
+    if counts is None:
+        return 0, 0, 0
+
+    total, iac = counts
+    ratio = (iac / total * 100) if total > 0 else 0
+    return total, iac, ratio
+
+def filter_repos(repos, writer, workers=WORKERS, backend="clone", clone_slots=None):
+    # Repos are processed concurrently, rows are written as soon as every previous repo is done
+    if clone_slots is None:
+        clone_slots = CloneSlots()
+
+    results = {}
+    next_index = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(process_repo, repo["clone_url"], backend=backend, clone_slots=clone_slots): index
+            for index, repo in enumerate(repos)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            total, iac, ratio = future.result()
+            keep = ratio >= MIN_IAC_RATIO
+            results[index] = keep
+
+            name = repos[index]["name"]
+            print(f"[{done}/{len(repos)}] {name}: {iac}/{total} IaC files ({round(ratio, 2)}%) -> {'keep' if keep else 'discard'}")
+
+            while next_index in results:
+                if results.pop(next_index):
+                    writer.writerow([repos[next_index]["name"], repos[next_index]["clone_url"]])
+                next_index += 1
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Filter IaC repositories")
     parser.add_argument("--in", dest="input_csv", default="repos.csv",
                         help="Input CSV filename (default: repos.csv)")
     parser.add_argument("--out", dest="output_csv", default="iac_repos.csv",
                         help="Output CSV filename (default: iac_repos.csv)")
+    parser.add_argument("--backend", choices=["clone", "api"], default="clone",
+                        help="Count files in a sparse clone, or every file of the tree from the Git Trees API "
+                             "(listed from a blobless clone for truncated trees), a different ratio that is not "
+                             "comparable (default: clone)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help=f"Number of repositories processed at the same time (default: {WORKERS})")
+    parser.add_argument("--max-clones", type=int, default=MAX_CLONES,
+                        help=f"Number of clones allowed to run at the same time (default: {MAX_CLONES})")
+    parser.add_argument("--tmp-dir", default=None,
+                        help="Directory of the temporary clones (default: system temp directory)")
+    parser.add_argument("--min-free-mb", type=int, default=MIN_FREE_TEMP_MB,
+                        help=f"Free space to keep in the temp directory, in MB (default: {MIN_FREE_TEMP_MB})")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     input_csv = args.input_csv
     output_csv = args.output_csv
@@ -101,14 +284,8 @@ if __name__ == "__main__":
     with open(output_csv, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
         writer.writerow(["name", "clone_url"])
-        
-        for repo in repos:
-            name = repo["name"]
-            url = repo["clone_url"]
-            total, iac, ratio = process_repo(url)
-            keep = ratio >= 11
-            
-            if keep:
-                writer.writerow([name, url])
-            
-            print(f"{name}: {iac}/{total} IaC files ({round(ratio, 2)}%) -> {'keep' if keep else 'discard'}")
\ No newline at end of file
+        clone_slots = CloneSlots(args.max_clones, args.tmp_dir, args.min_free_mb)
+        filter_repos(repos, writer, args.workers, args.backend, clone_slots)
+
+if __name__ == "__main__":
+    main()
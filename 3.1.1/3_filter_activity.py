@@ -2,82 +2,205 @@ import csv
 import subprocess
 import tempfile
 import shutil
-from datetime import datetime
 from collections import Counter
 import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from mirror_cache import MirrorCache, DEFAULT_MIRROR_DIR, DEFAULT_QUOTA_MB
+from activity_cache import ActivityCache, DEFAULT_ACTIVITY_CACHE_PATH
 
 MIN_COMMITS_PER_MONTH = 2
 MIN_ACTIVE_MONTHS = 12
+# Partial clone filter of the temporary clones: only commits are needed to date the history
+CLONE_FILTER = "tree:0"
+# Number of repositories evaluated at the same time
+WORKERS = 8
+# Attempts on authentication errors, the first retry waits AUTH_RETRY_DELAY seconds and the next ones twice longer
+AUTH_RETRIES = 2
+AUTH_RETRY_DELAY = 10
+
+@contextmanager
+def bare_clone(clone_url, mirrors=None, clone_filter=CLONE_FILTER, shallow_since=None):
+    # Git dir of the repository: its mirror when a cache is given, a temporary bare clone otherwise
+    # A temporary clone can be limited to the commits made since a date
+    if mirrors is not None:
+        with mirrors.mirror(clone_url) as git_dir:
+            yield git_dir
+        return
 
-def is_active_repo(clone_url, min_commits_per_month=MIN_COMMITS_PER_MONTH, min_active_months=MIN_ACTIVE_MONTHS, retry_on_auth=True):
     tmpdir = tempfile.mkdtemp()
     try:
+        filter_args = [f"--filter={clone_filter}"] if clone_filter else []
+        if shallow_since:
+            filter_args.append(f"--shallow-since={shallow_since}")
+        subprocess.run(
+            ["git", "clone", "--bare", *filter_args, clone_url, tmpdir],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+            text=True
+        )
+        subprocess.run(
+            ["git", "--git-dir", tmpdir, "commit-graph", "write", "--reachable"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+            text=True
+        )
+        yield tmpdir
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def monthly_commit_counts(git_dir, since_commit=None):
+    # Number of commits of every month, counted while git log streams the commit dates
+    # Returns the newest commit, its date and the counts; with since_commit, only newer commits are counted
+    revisions = [f"{since_commit}..HEAD"] if since_commit else []
+    process = subprocess.Popen(
+        ["git", "--git-dir", git_dir, "log", "--pretty=format:%H %cI", *revisions],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    newest_commit, newest_date = None, None
+    counter = Counter()
+    for line in process.stdout:
+        if not line.strip():
+            continue
+        sha, date = line.split()
+        if newest_commit is None:
+            newest_commit, newest_date = sha, date
+        # Dates are in the committer's timezone and start with YYYY-MM
+        counter[date[:7]] += 1
+    stderr = process.stderr.read()
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, stderr=stderr)
+    return newest_commit, newest_date, counter
+
+def is_ancestor(git_dir, commit):
+    result = subprocess.run(
+        ["git", "--git-dir", git_dir, "merge-base", "--is-ancestor", commit, "HEAD"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return result.returncode == 0
+
+def update_activity(clone_url, cached, mirrors=None, clone_filter=CLONE_FILTER):
+    # Monthly counts of the whole history, only counting the commits made since the cached ones
+    # Returns (newest commit, its date, counts)
+    if cached:
+        # A temporary clone only needs the commits since the last one counted
+        shallow_since = cached["last_commit_date"] if mirrors is None else None
+        with bare_clone(clone_url, mirrors, clone_filter, shallow_since) as git_dir:
+            if is_ancestor(git_dir, cached["last_commit"]):
+                newest_commit, newest_date, counter = monthly_commit_counts(git_dir, cached["last_commit"])
+                if newest_commit is None:
+                    # Nothing new since the last run
+                    return cached["last_commit"], cached["last_commit_date"], cached["months"]
+                return newest_commit, newest_date, cached["months"] + counter
+        # History was rewritten since the last run, count it all again
+        print(f"History of {clone_url} changed, counting it again")
+
+    with bare_clone(clone_url, mirrors, clone_filter) as git_dir:
+        return monthly_commit_counts(git_dir)
+
+def repo_activity(clone_url, mirrors=None, clone_filter=CLONE_FILTER, cache=None, offline=False, retries=AUTH_RETRIES):
+    # Monthly commit counts of a repository, None if they could not be computed
+    cached = cache.get(clone_url) if cache else None
+    if offline:
+        if cached is None:
+            print(f"No cached activity for {clone_url}")
+            return None
+        return cached["months"]
+
+    attempt = 0
+    while True:
         try:
-            subprocess.run(
-                ["git", "clone", "--bare", clone_url, tmpdir],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                check=True,
-                text=True
-            )
+            newest_commit, newest_date, counter = update_activity(clone_url, cached, mirrors, clone_filter)
+            break
         except subprocess.CalledProcessError as e:
-            stderr = e.stderr.lower()
+            stderr = (e.stderr or "").lower()
             if "authentication" in stderr or "permission denied" in stderr:
-                if retry_on_auth:
-                    print(f"Authentication issue for {clone_url}. Waiting 10s before retry...")
-                    time.sleep(10)
-                    return is_active_repo(clone_url, min_commits_per_month, min_active_months, retry_on_auth=False)
-                else:
-                    print(f"Repeated authentication failure for {clone_url}")
-                    return False
-            else:
-                print(f"Git error for {clone_url}: {e.stderr.strip()}")
-                return False
-
-        result = subprocess.run(
-            ["git", "--git-dir", tmpdir, "log", "--pretty=format:%cI"],
-            capture_output=True, text=True, check=True
-        )
-        
-        dates = [datetime.fromisoformat(d.strip()).replace(tzinfo=None) for d in result.stdout.splitlines()]
-        if not dates:
-            print(f"No commits found for {clone_url}")
-            return False
-
-        counter = Counter((d.year, d.month) for d in dates)
-        active_months = sum(1 for count in counter.values() if count >= min_commits_per_month)
-
-        if active_months >= min_active_months:
-            print(f"{clone_url} active ({active_months} months)")
-            return True
-        else:
-            print(f"{clone_url} inactive ({active_months} months)")
-            return False
+                attempt += 1
+                if attempt < retries:
+                    delay = AUTH_RETRY_DELAY * 2 ** (attempt - 1)
+                    print(f"Authentication issue for {clone_url}. Waiting {delay}s before retry...")
+                    time.sleep(delay)
+                    continue
+                print(f"Repeated authentication failure for {clone_url}")
+                return None
+            print(f"Git error for {clone_url}: {(e.stderr or '').strip()}")
+            return None
 
-    finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
+    if cache and newest_commit is not None:
+        cache.put(clone_url, newest_commit, newest_date, counter)
+    return counter
 
-if __name__ == "__main__":
+def is_active_repo(clone_url, min_commits_per_month=MIN_COMMITS_PER_MONTH, min_active_months=MIN_ACTIVE_MONTHS, retries=AUTH_RETRIES, mirrors=None, clone_filter=CLONE_FILTER, cache=None, offline=False):
+    counter = repo_activity(clone_url, mirrors, clone_filter, cache, offline, retries)
+    if counter is None:
+        return False
+
+    if not counter:
+        print(f"No commits found for {clone_url}")
+        return False
+
+    active_months = sum(1 for count in counter.values() if count >= min_commits_per_month)
+
+    if active_months >= min_active_months:
+        print(f"{clone_url} active ({active_months} months)")
+        return True
+    else:
+        print(f"{clone_url} inactive ({active_months} months)")
+        return False
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Filter active repositories")
     parser.add_argument("--in", dest="input_csv", default="iac_repos.csv")
     parser.add_argument("--out", dest="output_csv", default="iac_repos_active.csv")
-    args = parser.parse_args()
-    
+    parser.add_argument("--mirror-dir", default=None,
+                        help=f"Read repositories from persistent mirrors kept in this directory instead of "
+                             f"temporary clones (e.g. {DEFAULT_MIRROR_DIR})")
+    parser.add_argument("--mirror-quota-mb", type=int, default=DEFAULT_QUOTA_MB,
+                        help=f"Disk space of the mirrors before the least recently used are evicted (default: {DEFAULT_QUOTA_MB})")
+    parser.add_argument("--clone-filter", default=CLONE_FILTER,
+                        help=f"Partial clone filter of the temporary clones, e.g. tree:0 or blob:none, "
+                             f"empty for a full clone (default: {CLONE_FILTER})")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help=f"Number of repositories evaluated at the same time (default: {WORKERS})")
+    parser.add_argument("--min-commits-per-month", type=int, default=MIN_COMMITS_PER_MONTH,
+                        help=f"Commits needed for a month to count as active (default: {MIN_COMMITS_PER_MONTH})")
+    parser.add_argument("--min-active-months", type=int, default=MIN_ACTIVE_MONTHS,
+                        help=f"Active months needed for a repository to be kept (default: {MIN_ACTIVE_MONTHS})")
+    parser.add_argument("--activity-cache", default=DEFAULT_ACTIVITY_CACHE_PATH,
+                        help="SQLite file of the monthly commit counts of every repository, empty to disable it")
+    parser.add_argument("--offline", action="store_true",
+                        help="Only apply the thresholds to the cached monthly counts, without any clone or fetch")
+    args = parser.parse_args(argv)
+
     with open(args.input_csv, newline="", encoding="utf-8") as f:
         reader = csv.DictReader(f)
         repos = list(reader)
 
-    active_repos = []
-    for repo in repos:
-        url = repo["clone_url"]
-        name = repo["name"]
-        if is_active_repo(url):
-            active_repos.append(repo)
+    if args.offline and not args.activity_cache:
+        parser.error("--offline needs the activity cache")
+
+    mirrors = MirrorCache(args.mirror_dir, args.mirror_quota_mb) if args.mirror_dir else None
+    cache = ActivityCache(args.activity_cache) if args.activity_cache else None
+
+    # Results come back in input order, so the output does not depend on which repository finishes first
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        active = list(executor.map(
+            lambda repo: is_active_repo(repo["clone_url"], args.min_commits_per_month, args.min_active_months,
+                                        mirrors=mirrors, clone_filter=args.clone_filter, cache=cache,
+                                        offline=args.offline),
+            repos
+        ))
+    active_repos = [repo for repo, keep in zip(repos, active) if keep]
 
     with open(args.output_csv, "w", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
         writer.writeheader()
         writer.writerows(active_repos)
-    
-    print(f"Filtered {len(active_repos)} active repos (≥{MIN_COMMITS_PER_MONTH} commits/month for at least {MIN_ACTIVE_MONTHS} months)")
\ No newline at end of file
+
+    print(f"Filtered {len(active_repos)} active repos (≥{args.min_commits_per_month} commits/month for at least {args.min_active_months} months)")
+
+if __name__ == "__main__":
+    main()
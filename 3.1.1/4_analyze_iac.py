@@ -5,116 +5,659 @@ import subprocess
 import tempfile
 import shutil
 import re
+import posixpath
 import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from mirror_cache import MirrorCache, DEFAULT_MIRROR_DIR, DEFAULT_QUOTA_MB
+from metric_cache import MetricCache, DEFAULT_METRIC_CACHE_PATH
 
-def clone_repo(url, temp_dir):
+# Repositories cloned ahead of the analysis, and manifests analyzed by a single task of the process pool
+CLONE_WORKERS = 4
+FILES_PER_TASK = 64
+# Symbolic links followed to find the manifest a link points to, as the system does
+MAX_LINK_DEPTH = 40
+# Commits of a history read, analyzed and written at a time with --history
+HISTORY_WINDOW = 500
+# Columns of the output, one row per manifest
+FIELDNAMES = ['org', 'file_', 'URL', 'File', 'Lines_of_code', 'Require', 'Ensure',
+              'Include', 'Attribute', 'Hard_coded_string', 'Comment', 'Command',
+              'File_mode', 'SSH_KEY']
+
+def clone_repo(url, temp_dir, mirrors=None):
     repo_name = url.split('/')[-1].replace('.git', '')
     repo_path = os.path.join(temp_dir, repo_name)
     try:
-        subprocess.run(['git', 'clone', '--depth', '1', url, repo_path],
-                       check=True, capture_output=True, text=True)
+        if mirrors is None:
+            subprocess.run(['git', 'clone', '--depth', '1', url, repo_path],
+                           check=True, capture_output=True, text=True)
+        else:
+            with mirrors.mirror(url) as git_dir:
+                # Only the last snapshot is copied out of the mirror, which may then be evicted
+                subprocess.run(['git', 'clone', '--depth', '1', f"file://{os.path.abspath(git_dir)}", repo_path],
+                               check=True, capture_output=True, text=True)
         return repo_path
     except subprocess.CalledProcessError:
         return None
 
-def analyze_puppet_file(file_path):
+# Version of the metrics computed by analyze_puppet_content, to increase whenever their counting changes
+# so that the metrics cached for a previous version are not reused
+ANALYZER_VERSION = 1
+
+# Every metric of a manifest found in a single scan. Matches only consume text in which no other
+# metric can start (a quote, a hash sign, an arrow, a keyword or a URL scheme). The extent of strings,
+# comments and includes is read from lookaheads, so metrics are still found inside them
+# (a URL in a string, a keyword in a comment...).
+# Each alternative starts with its own set of characters, checked first to fail fast everywhere else.
+PUPPET_TOKENS = re.compile(
+    r"""
+        '(?=(?P<single_quoted>[^']+)')
+      | "(?=(?P<double_quoted>[^"]+)")
+      | (?P<comment>\#)
+        # Arrow following a word: the word is an attribute, and a file mode if it is "mode"
+      | (?=[\s=])(?<=\w)(?:(?<=\bmode)(?=(?P<file_mode>\s*=>\s*['"]?[0-7])))?(?P<attribute>\s*=>)
+      | (?=(?i:[rcefsi]))\b(?:
+            (?P<require>(?i:require)\b)
+          | (?P<ensure>(?i:ensure)\b)
+          | (?P<command>(?i:cmd)\b)
+          | (?P<file>(?i:file)\b)
+          | (?P<ssh_key>(?i:ssh_authorized_key)\b)
+          | (?i:include)(?=(?P<include>\s+[\w:]+))
+        )
+      | (?P<url_count>(?i:https?://))
+    """,
+    re.VERBOSE
+)
+
+def analyze_puppet_content(content):
     metrics = {
         'require': 0, 'ensure': 0, 'include': 0, 'attribute': 0,
         'hard_coded_string': 0, 'comment': 0, 'command': 0,
         'file_mode': 0, 'ssh_key': 0, 'file': 0, 'url_count': 0, 'lines_of_code': 0
     }
+    metrics['lines_of_code'] = len(content.splitlines())
 
+    # Strings, comments and includes do not overlap with themselves: one starting
+    # before the end of the previous one of the same kind is not counted
+    string_end = 0
+    comment_end = 0
+    include_end = 0
+    for match in PUPPET_TOKENS.finditer(content):
+        kind = match.lastgroup
+        if kind == 'attribute':
+            metrics['attribute'] += 1
+            if match.group('file_mode') is not None:
+                metrics['file_mode'] += 1
+        elif kind == 'single_quoted' or kind == 'double_quoted':
+            if match.start() >= string_end:
+                metrics['hard_coded_string'] += 1
+                # After the closing quote
+                string_end = match.end(kind) + 1
+        elif kind == 'comment':
+            start = match.start()
+            if start >= comment_end:
+                metrics['comment'] += 1
+                # A comment runs until the end of its line
+                comment_end = content.find('\n', start)
+                if comment_end < 0:
+                    comment_end = len(content)
+        elif kind == 'include':
+            if match.start() >= include_end:
+                metrics['include'] += 1
+                include_end = match.end('include')
+        else:
+            metrics[kind] += 1
+
+    return metrics
+
+def analyze_puppet_file(file_path):
     try:
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
             content = f.read()
 
-        metrics['lines_of_code'] = len(content.splitlines())
-        metrics['url_count'] = len(re.findall(r'https?://', content, re.IGNORECASE))
-        metrics['require'] = len(re.findall(r'\brequire\b', content, re.IGNORECASE))
-        metrics['ensure'] = len(re.findall(r'\bensure\b', content, re.IGNORECASE))
-        metrics['include'] = len(re.findall(r'\binclude\s+[\w:]+', content, re.IGNORECASE))
-        metrics['attribute'] = len(re.findall(r'\b\w+\s*=>', content))
-        metrics['hard_coded_string'] = len(re.findall(r"'[^']+'|\"[^\"]+\"", content))
-        metrics['comment'] = len(re.findall(r'#.*', content))
-        metrics['command'] = len(re.findall(r'\bcmd\b', content, re.IGNORECASE))
-        metrics['file'] = len(re.findall(r'\bfile\b', content, re.IGNORECASE))
-        metrics['file_mode'] = len(re.findall(r'\bmode\s*=>\s*[\'"]?[0-7]+[\'"]?', content))
-        metrics['ssh_key'] = len(re.findall(r'\bssh_authorized_key\b', content, re.IGNORECASE))
+        return analyze_puppet_content(content)
 
     except Exception as e:
         print(f"Error analyzing Puppet file {file_path}: {e}")
+        return analyze_puppet_content("")
 
-    return metrics
+def manifest_row(org_name, repo_name, rel_path, metrics):
+    return {
+        'org': org_name.upper(),
+        'file_': repo_name + "/" + rel_path,
+        'URL': metrics['url_count'],
+        'File': metrics['file'],
+        'Lines_of_code': metrics['lines_of_code'],
+        'Require': metrics['require'],
+        'Ensure': metrics['ensure'],
+        'Include': metrics['include'],
+        'Attribute': metrics['attribute'],
+        'Hard_coded_string': metrics['hard_coded_string'],
+        'Comment': metrics['comment'],
+        'Command': metrics['command'],
+        'File_mode': metrics['file_mode'],
+        'SSH_KEY': metrics['ssh_key']
+    }
 
-def analyze_repository(repo_path, org_name, repo_name):
-    results = []
+def iter_manifests(repo_path):
+    # Paths of the .pp files of a clone, relative to its root
     for root, _, files in os.walk(repo_path):
         for file in files:
             if file.endswith('.pp'):
-                file_path = os.path.join(root, file)
-                rel_path = os.path.relpath(file_path, repo_path)
-
-                metrics = analyze_puppet_file(file_path)
-
-                result = {
-                    'org': org_name.upper(),
-                    'file_': repo_name + "/" + rel_path,
-                    'URL': metrics['url_count'],
-                    'File': metrics['file'],
-                    'Lines_of_code': metrics['lines_of_code'],
-                    'Require': metrics['require'],
-                    'Ensure': metrics['ensure'],
-                    'Include': metrics['include'],
-                    'Attribute': metrics['attribute'],
-                    'Hard_coded_string': metrics['hard_coded_string'],
-                    'Comment': metrics['comment'],
-                    'Command': metrics['command'],
-                    'File_mode': metrics['file_mode'],
-                    'SSH_KEY': metrics['ssh_key']
-                }
-                results.append(result)
-    return results
-
-def main():
+                yield os.path.relpath(os.path.join(root, file), repo_path)
+
+def tree_entries(repo_path):
+    # (mode, type, SHA) of every file and directory of the last commit, by path relative to the root
+    # Works on clones and on bare repositories, None if the tree cannot be listed
+    result = subprocess.run(['git', '-C', repo_path, 'ls-tree', '-r', '-t', '-z', 'HEAD'],
+                            capture_output=True, encoding='utf-8', errors='surrogateescape')
+    if result.returncode != 0:
+        return None
+    entries = {}
+    for entry in result.stdout.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        mode, kind, sha = info.split()
+        entries[path] = (mode, kind, sha)
+    return entries
+
+def manifest_blobs(repo_path):
+    # Blob SHA of every regular file committed in a clone, by path relative to its root
+    # A symbolic link is read through its target, its own blob is not the analyzed content
+    return {path: sha for path, (mode, kind, sha) in (tree_entries(repo_path) or {}).items()
+            if kind == 'blob' and mode in ('100644', '100755')}
+
+class BlobReader:
+    """
+    Contents of the objects of a repository, all read through a single git cat-file --batch process.
+    In a partial clone, a blob that was not downloaded is fetched on the fly.
+    """
+    def __init__(self, git_dir):
+        self._process = subprocess.Popen(['git', '-C', git_dir, 'cat-file', '--batch'],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def read(self, sha):
+        # Bytes of the object, None if it does not exist
+        self._process.stdin.write(sha.encode('ascii') + b'\n')
+        self._process.stdin.flush()
+        header = self._process.stdout.readline().split()
+        if len(header) != 3:
+            return None
+        data = self._process.stdout.read(int(header[2]))
+        # Newline following the content
+        self._process.stdout.read(1)
+        return data
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def resolve_link(path, entries, blobs):
+    # Entry a symbolic link of the tree points to, following links to links
+    # None if it points outside the repository or to nothing
+    for _ in range(MAX_LINK_DEPTH):
+        mode, kind, sha = entries[path]
+        if mode != '120000':
+            return entries[path]
+        target = blobs.read(sha)
+        if target is None:
+            return None
+        target = target.decode('utf-8', errors='surrogateescape')
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(path), target))
+        if posixpath.isabs(path) or path == '..' or path.startswith('../') or path not in entries:
+            return None
+    return None
+
+def fetch_blobs(git_dir, shas):
+    # Download blobs missing from a partial clone in a single request, as git itself does before a checkout
+    subprocess.run(['git', '-C', git_dir, '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', 'origin',
+                    '--no-tags', '--no-write-fetch-head', '--recurse-submodules=no', '--filter=blob:none', '--stdin'],
+                   input=''.join(f"{sha}\n" for sha in shas), check=True, capture_output=True, text=True)
+
+@contextmanager
+def object_store(url, temp_dir, mirrors=None, history=False):
+    """
+    Yield (git_dir, partial) for reading the objects of a repository without any checkout:
+    its mirror when a cache is given, otherwise a temporary bare clone of the last commit
+    (of the whole history with history=True) holding its commits and trees only,
+    whose blobs must be fetched (partial is True).
+    Raises subprocess.CalledProcessError if the repository cannot be cloned.
+    """
+    if mirrors is not None:
+        with mirrors.mirror(url) as git_dir:
+            yield git_dir, False
+        return
+
+    git_dir = tempfile.mkdtemp(dir=temp_dir)
+    try:
+        depth_args = [] if history else ['--depth', '1']
+        subprocess.run(['git', 'clone', '--bare', *depth_args, '--filter=blob:none', url, git_dir],
+                       check=True, capture_output=True, text=True)
+        yield git_dir, True
+    finally:
+        shutil.rmtree(git_dir, ignore_errors=True)
+
+def decode_manifest(data):
+    # Same text as reading the file with analyze_puppet_file: undecodable bytes are dropped
+    # and newlines are translated
+    return data.decode('utf-8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
+
+def analyze_manifests(repo_path, rel_paths):
+    # Metrics of a batch of manifests, run in the worker processes
+    return [analyze_puppet_file(os.path.join(repo_path, rel_path)) for rel_path in rel_paths]
+
+def analyze_blobs(blobs):
+    # Metrics of a batch of manifest contents read from the object store, run in the worker processes
+    return [analyze_puppet_content(decode_manifest(data)) for data in blobs]
+
+def analyze_repository(repo_path, org_name, repo_name):
+    rel_paths = list(iter_manifests(repo_path))
+    return [manifest_row(org_name, repo_name, rel_path, metrics)
+            for rel_path, metrics in zip(rel_paths, analyze_manifests(repo_path, rel_paths))]
+
+def checkout_repository(url, temp_dir, mirrors=None, cache=None):
+    """
+    Clone the last commit of a repository into its own directory and list its manifests.
+    Returns a dict with the clone path, the (rel_path, blob SHA) of its manifests and the
+    cached metrics of their blobs, or None if the clone failed.
+    """
+    # One directory per clone, so repositories with the same name do not collide
+    repo_path = clone_repo(url, tempfile.mkdtemp(dir=temp_dir), mirrors)
+    if repo_path is None:
+        return None
+    blobs = manifest_blobs(repo_path) if cache else {}
+    manifests = [(rel_path, blobs.get(rel_path)) for rel_path in iter_manifests(repo_path)]
+    known = cache.get_many([sha for _, sha in manifests if sha]) if cache else {}
+    return {'path': repo_path, 'manifests': manifests, 'known': known, 'contents': None}
+
+def read_repository(url, temp_dir, mirrors=None, cache=None):
+    """
+    List the manifests of the last commit of a repository with git ls-tree and read the content
+    of their blobs from the object store, without any checkout nor walk of the other files.
+    Only the blobs whose metrics are not cached are read, and downloaded when the clone is partial.
+    Returns the same dict as checkout_repository, with the content of the blobs to analyze
+    instead of a clone path, or None if the repository could not be read.
+    """
+    try:
+        with object_store(url, temp_dir, mirrors) as (git_dir, partial):
+            entries = tree_entries(git_dir)
+            if entries is None:
+                return None
+            with BlobReader(git_dir) as blobs:
+                manifests = []
+                for path, entry in entries.items():
+                    if not path.endswith('.pp') or entry[1] != 'blob':
+                        continue
+                    # A link is analyzed through its target, skipped if it is not a file of the repository
+                    entry = resolve_link(path, entries, blobs)
+                    if entry is not None and entry[1] == 'blob':
+                        manifests.append((path, entry[2]))
+
+                known = cache.get_many([sha for _, sha in manifests]) if cache else {}
+                needed = list(dict.fromkeys(sha for _, sha in manifests if sha not in known))
+                if partial and needed:
+                    fetch_blobs(git_dir, needed)
+                contents = {sha: blobs.read(sha) for sha in needed}
+    except subprocess.CalledProcessError:
+        return None
+    if any(data is None for data in contents.values()):
+        return None
+    return {'path': None, 'manifests': manifests, 'known': known, 'contents': contents}
+
+def read_fields(stream, separator=b'\0', size=1 << 16):
+    # Fields of a separated output, read a chunk at a time instead of all at once
+    rest = b''
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        fields = (rest + chunk).split(separator)
+        rest = fields.pop()
+        yield from fields
+    yield rest
+
+def manifest_changes(git_dir):
+    """
+    Walk the first-parent history of a repository from its first commit, listing the manifests
+    each commit adds, modifies or deletes.
+    Yields (commit SHA, commit date, [(rel_path, status, blob SHA or None if deleted)]) as git log
+    goes, so the whole history is never held in memory.
+    Only regular files are followed: symbolic links and submodules named like manifests are ignored.
+    Raises subprocess.CalledProcessError if git log fails.
+    """
+    # Trees are compared without rename detection, so no blob has to be read
+    process = subprocess.Popen(['git', '-C', git_dir, 'log', '--first-parent', '--reverse', '--no-renames',
+                                '--no-abbrev', '--raw', '-z', '--format=commit %H %cI', '--', '*.pp'],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        commit = None
+        fields = (field.decode('utf-8', errors='surrogateescape') for field in read_fields(process.stdout))
+        for field in fields:
+            field = field.lstrip('\n')
+            if field.startswith('commit '):
+                if commit and commit[2]:
+                    yield commit
+                _, sha, date = field.split()
+                commit = (sha, date, [])
+            elif field.startswith(':'):
+                old_mode, new_mode, _, new_sha, status = field[1:].split()
+                rel_path = next(fields)
+                # The pathspec also matches files inside directories named like manifests
+                if not rel_path.endswith('.pp'):
+                    continue
+                if new_mode in ('100644', '100755'):
+                    commit[2].append((rel_path, status, new_sha))
+                elif old_mode in ('100644', '100755'):
+                    commit[2].append((rel_path, 'D', None))
+        if commit and commit[2]:
+            yield commit
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    finally:
+        # The walk may be abandoned before git log is done
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+def open_history(url, temp_dir, mirrors=None):
+    """
+    Open the object store of a repository with its whole history (see object_store), kept until
+    the returned 'store' is closed. Returns None if the repository could not be cloned.
+    """
+    store = ExitStack()
+    try:
+        git_dir, partial = store.enter_context(object_store(url, temp_dir, mirrors, history=True))
+    except subprocess.CalledProcessError:
+        store.close()
+        return None
+    return {'git_dir': git_dir, 'partial': partial, 'store': store}
+
+def history_windows(history, analyzed, cache=None, window=HISTORY_WINDOW):
+    """
+    Walk the manifest changes of an opened history (see manifest_changes) window commits at a time,
+    reading the content of the blobs of each window whose metrics are neither in analyzed nor cached,
+    downloaded when the clone is partial.
+    Yields a dict per window with its changes, the known metrics and the contents, or None and stops
+    if a blob could not be read. Raises subprocess.CalledProcessError if git fails.
+    """
+    git_dir = history['git_dir']
+    changes = manifest_changes(git_dir)
+    with BlobReader(git_dir) as blobs:
+        while True:
+            window_changes = list(itertools.islice(changes, window))
+            if not window_changes:
+                return
+            shas = [sha for _, _, files in window_changes for _, _, sha in files if sha]
+            known = {sha: analyzed[sha] for sha in shas if sha in analyzed}
+            if cache:
+                known.update(cache.get_many([sha for sha in shas if sha not in known]))
+            needed = list(dict.fromkeys(sha for sha in shas if sha not in known))
+            if history['partial'] and needed:
+                fetch_blobs(git_dir, needed)
+            contents = {sha: blobs.read(sha) for sha in needed}
+            if any(data is None for data in contents.values()):
+                yield None
+                return
+            yield {'changes': window_changes, 'known': known, 'contents': contents}
+
+def iter_repositories(repos, load_repository, clone_workers=CLONE_WORKERS):
+    """
+    Load the repositories in background threads, at most clone_workers ahead of the consumer.
+    Yields (repo_name, repo) in input order, repo being what load_repository returned for the clone URL.
+    """
+    with ThreadPoolExecutor(max_workers=clone_workers) as executor:
+        loading = deque()
+        repos = iter(repos)
+        while True:
+            while len(loading) < clone_workers:
+                row = next(repos, None)
+                if row is None:
+                    break
+                loading.append((row['name'], executor.submit(load_repository, row['clone_url'])))
+            if not loading:
+                return
+            repo_name, future = loading.popleft()
+            yield repo_name, future.result()
+
+def submit_batches(pool, repo, files_per_task=FILES_PER_TASK):
+    """
+    Submit the analysis of the manifests of a repository (see checkout_repository) to a process pool,
+    files_per_task at a time. Manifests whose blob is cached are not analyzed, and each distinct
+    blob of a batch is analyzed once.
+    Yields the batches in order as they are submitted, as dicts with the manifests of the batch,
+    the ones being analyzed and the future of their metrics. A repository without manifests gives
+    a single empty batch, and the last batch is flagged.
+    """
+    manifests = repo['manifests']
+    batches = [manifests[i:i + files_per_task] for i in range(0, len(manifests), files_per_task)] or [[]]
+    for i, batch in enumerate(batches):
+        missing = []
+        seen = set()
+        for rel_path, sha in batch:
+            if sha is None:
+                missing.append(rel_path)
+            elif sha not in repo['known'] and sha not in seen:
+                seen.add(sha)
+                missing.append(rel_path)
+
+        future = None
+        if missing and repo['contents'] is None:
+            future = pool.submit(analyze_manifests, repo['path'], missing)
+        elif missing:
+            shas = dict(batch)
+            future = pool.submit(analyze_blobs, [repo['contents'][shas[rel_path]] for rel_path in missing])
+        yield {'manifests': batch, 'missing': missing, 'last': i == len(batches) - 1, 'future': future}
+
+def batch_rows(org_name, repo_name, repo, batch, cache=None):
+    # Output rows of a submitted batch, waiting for its metrics, which are then added to the cache
+    metrics_by_path = {}
+    if batch['future'] is not None:
+        metrics_by_path = dict(zip(batch['missing'], batch['future'].result()))
+    shas = dict(batch['manifests'])
+    analyzed = {shas[rel_path]: metrics for rel_path, metrics in metrics_by_path.items() if shas[rel_path]}
+    if cache and analyzed:
+        cache.put_many(analyzed)
+    known = {**repo['known'], **analyzed}
+
+    return [manifest_row(org_name, repo_name, rel_path,
+                         metrics_by_path[rel_path] if rel_path in metrics_by_path else known[sha])
+            for rel_path, sha in batch['manifests']]
+
+def repository_rows(pool, org_name, repo_name, repo, files_per_task=FILES_PER_TASK, cache=None):
+    # Output rows of every manifest of a loaded repository, analyzed in the pool, then deletes its clone
+    try:
+        return [row for batch in submit_batches(pool, repo, files_per_task)
+                for row in batch_rows(org_name, repo_name, repo, batch, cache)]
+    finally:
+        if repo['path']:
+            shutil.rmtree(os.path.dirname(repo['path']), ignore_errors=True)
+
+def start_workers(pool):
+    # Start the worker processes before any thread runs git: a process forked while a pipe
+    # to git is open keeps it open, and git would then never see the end of its input
+    pool.submit(int).result()
+
+def analyze_repositories(repos, org_name, writer, temp_dir, mirrors=None, processes=None,
+                         clone_workers=CLONE_WORKERS, files_per_task=FILES_PER_TASK, cache=None,
+                         checkout=True):
+    """
+    Analyze the manifests of every repository in a process pool while the next repositories are loaded.
+    Rows are written in input order as soon as they are ready, and a clone is deleted once all its
+    files are analyzed, so memory and disk usage do not grow with the number of repositories.
+    With a metric cache, manifests whose blob was already analyzed are not read at all.
+    Without checkout, manifests are read from the git object store instead of a clone (see read_repository).
+    Returns the number of files analyzed.
+    """
+    processes = processes or os.cpu_count()
+    # Batches submitted but not written yet: enough to keep every process busy between repositories
+    max_pending = processes * 4
+    # (repo_name, repo, batch) in input order, with the future of the metrics still to compute
+    pending = deque()
+    repo_counts = {}
+    total = 0
+
+    def write_oldest():
+        nonlocal total
+        repo_name, repo, batch = pending.popleft()
+        if repo is None:
+            print(f"  → Error cloning {repo_name}")
+            return
+
+        rows = batch_rows(org_name, repo_name, repo, batch, cache)
+        writer.writerows(rows)
+        total += len(rows)
+        repo_counts[repo_name] = repo_counts.get(repo_name, 0) + len(rows)
+
+        if batch['last']:
+            print(f"  → {repo_name}: {repo_counts.pop(repo_name, 0)} IaC files analyzed")
+            if repo['path']:
+                shutil.rmtree(os.path.dirname(repo['path']), ignore_errors=True)
+
+    if checkout:
+        load_repository = lambda url: checkout_repository(url, temp_dir, mirrors, cache)
+    else:
+        load_repository = lambda url: read_repository(url, temp_dir, mirrors, cache)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        start_workers(pool)
+        for repo_name, repo in iter_repositories(repos, load_repository, clone_workers):
+            print(f"Analyzing repository: {repo_name}")
+            if repo is None:
+                pending.append((repo_name, None, None))
+                continue
+
+            for batch in submit_batches(pool, repo, files_per_task):
+                pending.append((repo_name, repo, batch))
+                while len(pending) > max_pending:
+                    write_oldest()
+
+        while pending:
+            write_oldest()
+
+    return total
+
+def analyze_histories(repos, org_name, writer, temp_dir, mirrors=None, processes=None,
+                      clone_workers=CLONE_WORKERS, files_per_task=FILES_PER_TASK, cache=None,
+                      window=HISTORY_WINDOW):
+    """
+    Write one row per (manifest, commit) for every commit of the first-parent history of the
+    repositories that adds, modifies or deletes a manifest, oldest commit first.
+    A manifest keeps the metrics of its last row until a later commit changes it; deleted ones get a
+    row without metrics. Each distinct blob is analyzed once, and never again when its metrics are cached.
+    The history is read, analyzed and written window commits at a time, so memory does not grow with
+    its length; a repository failing halfway keeps the rows of the windows already written.
+    Returns the number of rows written.
+    """
+    processes = processes or os.cpu_count()
+    total = 0
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        start_workers(pool)
+        load_history = lambda url: open_history(url, temp_dir, mirrors)
+        for repo_name, history in iter_repositories(repos, load_history, clone_workers):
+            print(f"Analyzing history of repository: {repo_name}")
+            if history is None:
+                print(f"  → Error cloning {repo_name}")
+                continue
+
+            # Metrics of the blobs analyzed in the previous windows of the repository
+            analyzed = {}
+            commits = 0
+            with history['store']:
+                try:
+                    for changes in history_windows(history, analyzed, cache, window):
+                        if changes is None:
+                            print(f"  → Error reading the history of {repo_name}")
+                            break
+
+                        needed = list(changes['contents'])
+                        batches = [needed[i:i + files_per_task] for i in range(0, len(needed), files_per_task)]
+                        futures = [pool.submit(analyze_blobs, [changes['contents'][sha] for sha in batch])
+                                   for batch in batches]
+                        new = {}
+                        for batch, future in zip(batches, futures):
+                            new.update(zip(batch, future.result()))
+                        if cache and new:
+                            cache.put_many(new)
+                        analyzed.update(new)
+                        known = {**changes['known'], **new}
+
+                        rows = []
+                        for commit, date, files in changes['changes']:
+                            for rel_path, status, sha in files:
+                                row = {'org': org_name.upper(), 'file_': repo_name + "/" + rel_path}
+                                if sha is not None:
+                                    row = manifest_row(org_name, repo_name, rel_path, known[sha])
+                                rows.append({**row, 'commit': commit, 'date': date, 'change': status})
+                        writer.writerows(rows)
+                        total += len(rows)
+                        commits += len(changes['changes'])
+                except subprocess.CalledProcessError:
+                    print(f"  → Error reading the history of {repo_name}")
+                    continue
+            print(f"  → {repo_name}: {commits} commits, {len(analyzed)} new blobs analyzed")
+
+    return total
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Analyze IaC repositories (without defect status)')
     parser.add_argument('--in', dest="input", required=True, help='CSV file of active IaC repos')
     parser.add_argument('--out', dest="output", required=True, help="Output CSV file for results")
     parser.add_argument('--org', dest="org", required=False, default="", help="Organization name for labeling")
-    args = parser.parse_args()
+    parser.add_argument('--mirror-dir', dest="mirror_dir", default=None,
+                        help=f"Read repositories from persistent mirrors kept in this directory (e.g. {DEFAULT_MIRROR_DIR})")
+    parser.add_argument('--mirror-quota-mb', dest="mirror_quota_mb", type=int, default=DEFAULT_QUOTA_MB,
+                        help=f"Disk space of the mirrors before the least recently used are evicted (default: {DEFAULT_QUOTA_MB})")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Processes analyzing the manifests (default: number of CPUs)")
+    parser.add_argument('--clone-workers', dest="clone_workers", type=int, default=CLONE_WORKERS,
+                        help=f"Repositories cloned at the same time, ahead of the analysis (default: {CLONE_WORKERS})")
+    parser.add_argument('--metric-cache', dest="metric_cache", default=DEFAULT_METRIC_CACHE_PATH,
+                        help="SQLite file of the metrics of every analyzed blob, empty to disable it")
+    parser.add_argument('--source', choices=["checkout", "objects"], default="checkout",
+                        help="Analyze the manifests of a checked out clone, or read them straight from "
+                             "the git object store without checkout (default: checkout)")
+    parser.add_argument('--history', action="store_true",
+                        help="Write the metrics of the manifests changed by every commit of the history "
+                             "instead of the last commit only")
+    args = parser.parse_args(argv)
 
     if not os.path.exists(args.input):
         print(f"Input file not found: {args.input}")
         sys.exit(1)
 
-    all_results = []
     temp_dir = tempfile.mkdtemp()
+    mirrors = MirrorCache(args.mirror_dir, args.mirror_quota_mb) if args.mirror_dir else None
+    cache = MetricCache(ANALYZER_VERSION, args.metric_cache) if args.metric_cache else None
 
     try:
-        with open(args.input, 'r', newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                repo_name = row['name']
-                clone_url = row['clone_url']
-                print(f"Analyzing repository: {repo_name}")
-
-                repo_path = clone_repo(clone_url, temp_dir)
-                if repo_path:
-                    repo_results = analyze_repository(repo_path, args.org, repo_name)
-                    all_results.extend(repo_results)
-                    print(f"  → {len(repo_results)} IaC files analyzed")
-                else:
-                    print(f"  → Error cloning {repo_name}")
-
-        fieldnames = ['org', 'file_', 'URL', 'File', 'Lines_of_code', 'Require', 'Ensure',
-                      'Include', 'Attribute', 'Hard_coded_string', 'Comment', 'Command',
-                      'File_mode', 'SSH_KEY']
-
-        with open(args.output, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        fieldnames = list(FIELDNAMES)
+        if args.history:
+            fieldnames[2:2] = ['commit', 'date', 'change']
+
+        with open(args.input, 'r', newline='', encoding='utf-8') as input_csv, \
+                open(args.output, 'w', newline='', encoding='utf-8') as output_csv:
+            writer = csv.DictWriter(output_csv, fieldnames=fieldnames)
             writer.writeheader()
-            writer.writerows(all_results)
+            if args.history:
+                total = analyze_histories(csv.DictReader(input_csv), args.org, writer, temp_dir, mirrors,
+                                          args.processes, args.clone_workers, cache=cache)
+            else:
+                total = analyze_repositories(csv.DictReader(input_csv), args.org, writer, temp_dir, mirrors,
+                                             args.processes, args.clone_workers, cache=cache,
+                                             checkout=args.source == "checkout")
 
-        print(f"Total files analyzed: {len(all_results)}")
+        print(f"Total {'file changes' if args.history else 'files'} analyzed: {total}")
 
     finally:
         shutil.rmtree(temp_dir)
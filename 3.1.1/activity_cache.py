@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+DEFAULT_ACTIVITY_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "activity.sqlite")
+
+class ActivityCache:
+    """
+    Number of commits of every month for each repository, with the newest commit counted,
+    so a later run only has to count the commits made since then.
+    """
+    def __init__(self, path=DEFAULT_ACTIVITY_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS repos ("
+            " clone_url TEXT PRIMARY KEY, last_commit TEXT NOT NULL, last_commit_date TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS months ("
+            " clone_url TEXT NOT NULL, month TEXT NOT NULL, commits INTEGER NOT NULL,"
+            " PRIMARY KEY (clone_url, month))"
+        )
+        self._conn.commit()
+
+    def get(self, clone_url):
+        # Returns the cached activity of a repository as a dict, or None
+        with self._lock:
+            repo = self._conn.execute(
+                "SELECT last_commit, last_commit_date FROM repos WHERE clone_url = ?", (clone_url,)
+            ).fetchone()
+            if repo is None:
+                return None
+            months = self._conn.execute(
+                "SELECT month, commits FROM months WHERE clone_url = ?", (clone_url,)
+            ).fetchall()
+        last_commit, last_commit_date = repo
+        return {"last_commit": last_commit, "last_commit_date": last_commit_date, "months": Counter(dict(months))}
+
+    def put(self, clone_url, last_commit, last_commit_date, months):
+        # Replaces the whole histogram of the repository
+        with self._lock:
+            self._conn.execute("DELETE FROM months WHERE clone_url = ?", (clone_url,))
+            self._conn.executemany(
+                "INSERT INTO months (clone_url, month, commits) VALUES (?, ?, ?)",
+                [(clone_url, month, commits) for month, commits in months.items()]
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO repos (clone_url, last_commit, last_commit_date, updated_at) VALUES (?, ?, ?, ?)",
+                (clone_url, last_commit, last_commit_date, time.time())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,72 @@
+import os
+import re
+import sys
+import time
+import argparse
+import importlib
+
+# The scanner lives in a script whose name is not a valid module name
+analyze_iac = importlib.import_module("4_analyze_iac")
+
+def legacy_analyze_puppet_content(content):
+    # One findall per metric, as analyze_puppet_file used to do
+    return {
+        'require': len(re.findall(r'\brequire\b', content, re.IGNORECASE)),
+        'ensure': len(re.findall(r'\bensure\b', content, re.IGNORECASE)),
+        'include': len(re.findall(r'\binclude\s+[\w:]+', content, re.IGNORECASE)),
+        'attribute': len(re.findall(r'\b\w+\s*=>', content)),
+        'hard_coded_string': len(re.findall(r"'[^']+'|\"[^\"]+\"", content)),
+        'comment': len(re.findall(r'#.*', content)),
+        'command': len(re.findall(r'\bcmd\b', content, re.IGNORECASE)),
+        'file_mode': len(re.findall(r'\bmode\s*=>\s*[\'"]?[0-7]+[\'"]?', content)),
+        'ssh_key': len(re.findall(r'\bssh_authorized_key\b', content, re.IGNORECASE)),
+        'file': len(re.findall(r'\bfile\b', content, re.IGNORECASE)),
+        'url_count': len(re.findall(r'https?://', content, re.IGNORECASE)),
+        'lines_of_code': len(content.splitlines())
+    }
+
+def load_manifests(paths):
+    manifests = []
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for file in files:
+                if file.endswith('.pp'):
+                    with open(os.path.join(root, file), 'r', encoding='utf-8', errors='ignore') as f:
+                        manifests.append((os.path.join(root, file), f.read()))
+    return manifests
+
+def best_time(analyze, contents, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in contents:
+            analyze(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the single pass Puppet scanner with the per metric regexes")
+    parser.add_argument("paths", nargs="+", help="Directories (e.g. clones of Puppet repositories) whose .pp files are scanned")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs of each implementation, the best is kept (default: 5)")
+    args = parser.parse_args()
+
+    manifests = load_manifests(args.paths)
+    if not manifests:
+        print("No .pp file found")
+        sys.exit(1)
+    size = sum(len(content) for _, content in manifests)
+    print(f"{len(manifests)} manifests, {size / 1e6:.1f} MB")
+
+    mismatches = [path for path, content in manifests
+                  if analyze_iac.analyze_puppet_content(content) != legacy_analyze_puppet_content(content)]
+    for path in mismatches:
+        print(f"Different counts for {path}")
+
+    contents = [content for _, content in manifests]
+    legacy = best_time(legacy_analyze_puppet_content, contents, args.repeat)
+    single_pass = best_time(analyze_iac.analyze_puppet_content, contents, args.repeat)
+    print(f"Per metric regexes: {legacy:.3f}s ({size / legacy / 1e6:.1f} MB/s)")
+    print(f"Single pass:        {single_pass:.3f}s ({size / single_pass / 1e6:.1f} MB/s)")
+    print(f"Speedup: x{legacy / single_pass:.2f}")
+    sys.exit(1 if mismatches else 0)
@@ -1,12 +1,32 @@
 import os
+import json
 import requests
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from response_cache import ResponseCache, DEFAULT_CACHE_PATH
 
 load_dotenv()
 
+# Number of requests allowed in flight at the same time for a single API key
+MAX_IN_FLIGHT_PER_KEY = 4
+# Hourly budget of an authenticated key, used until GitHub reports the real value
+DEFAULT_RATE_LIMIT = 5000
+# Pause applied to a key hitting a secondary rate limit that gives no Retry-After
+SECONDARY_RATE_LIMIT_WAIT = 60
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+
+class GitHubAPIError(Exception):
+    # A request that failed for good, status_code being None when no response was received
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
 class GitHubAPIManager:
-    def __init__(self):
+    def __init__(self, max_in_flight_per_key=MAX_IN_FLIGHT_PER_KEY, cache_path=os.getenv('GITHUB_API_CACHE', DEFAULT_CACHE_PATH)):
         self.api_keys = [
             os.getenv('GITHUB_API_KEY_1'),
             os.getenv('GITHUB_API_KEY_2'),
@@ -15,46 +35,234 @@ class GitHubAPIManager:
             os.getenv('GITHUB_API_KEY_5')
         ]
         self.api_keys = [key for key in self.api_keys if key]
-        self.current_key_index = 0
-        
-    def _get_headers(self):
-        return {
-            'Authorization': f'token {self.api_keys[self.current_key_index]}',
+        self.max_in_flight_per_key = max_in_flight_per_key
+
+        # One persistent session per key so connections are kept alive between requests
+        self.sessions = [self._create_session(key) for key in self.api_keys]
+        self.in_flight = [0] * len(self.api_keys)
+        self.invalid_keys = set()
+        self._key_available = threading.Condition()
+
+        # Rate limit state of each key, as reported by the X-RateLimit-* / Retry-After headers
+        # REST and GraphQL calls have separate budgets, kept by (key index, X-RateLimit-Resource)
+        self.remaining = {}
+        self.reset_at = {}
+        # Secondary rate limits and Retry-After pause the whole key
+        self.blocked_until = [0.0] * len(self.api_keys)
+
+        # Responses are revalidated with ETag/Last-Modified, an empty path disables the cache
+        self.cache = ResponseCache(cache_path) if cache_path else None
+
+    def _create_session(self, key):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight_per_key)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Authorization': f'token {key}',
             'Accept': 'application/vnd.github.v3+json'
-        }
-    
-    def _rotate_key(self):
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        print(f"Rotating to key {self.current_key_index + 1}")
-    
-    def make_request(self, url, params=None, max_retries=3):
-        for attempt in range(max_retries):
+        })
+        return session
+
+    def set_max_in_flight_per_key(self, max_in_flight_per_key):
+        # Changes the number of requests allowed in flight for each key, for every user of the client
+        with self._key_available:
+            self.max_in_flight_per_key = max_in_flight_per_key
+            self.sessions = [self._create_session(key) for key in self.api_keys]
+            self._key_available.notify_all()
+
+    def _budget(self, key_index, resource, now):
+        if self.blocked_until[key_index] > now:
+            return 0
+        remaining = self.remaining.get((key_index, resource))
+        if remaining is None or self.reset_at.get((key_index, resource), 0.0) <= now:
+            # Unknown yet or the window has been reset: assume the full hourly budget
+            return DEFAULT_RATE_LIMIT - self.in_flight[key_index]
+        return remaining - self.in_flight[key_index]
+
+    def _next_reset(self, key_index, resource):
+        return max(self.reset_at.get((key_index, resource), 0.0), self.blocked_until[key_index])
+
+    def _acquire_key(self, resource="core"):
+        # Wait for the valid key with the most remaining budget of the resource that still has a free slot
+        with self._key_available:
+            while True:
+                valid_keys = [i for i in range(len(self.api_keys)) if i not in self.invalid_keys]
+                if not valid_keys:
+                    return None
+
+                now = time.time()
+                budgets = {i: self._budget(i, resource, now) for i in valid_keys}
+                free_keys = [i for i in valid_keys if budgets[i] > 0 and self.in_flight[i] < self.max_in_flight_per_key]
+                if free_keys:
+                    key_index = max(free_keys, key=lambda i: budgets[i])
+                    self.in_flight[key_index] += 1
+                    return key_index
+
+                if any(budgets[i] > 0 for i in valid_keys):
+                    # Some key has budget left, wait for one of its requests to finish
+                    self._key_available.wait()
+                else:
+                    # Every key is exhausted, pause only until the earliest reset
+                    wait = min(self._next_reset(i, resource) for i in valid_keys) - now
+                    print(f"Rate limit reached for all keys, waiting {round(wait)}s")
+                    self._key_available.wait(timeout=max(wait, 0) + 1)
+
+    def _release_key(self, key_index):
+        with self._key_available:
+            self.in_flight[key_index] -= 1
+            self._key_available.notify_all()
+
+    def _invalidate_key(self, key_index):
+        with self._key_available:
+            self.invalid_keys.add(key_index)
+            self._key_available.notify_all()
+
+    def _update_rate_limit(self, key_index, response, resource):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        retry_after = response.headers.get('Retry-After')
+        resource = response.headers.get('X-RateLimit-Resource', resource)
+
+        with self._key_available:
+            if remaining is not None:
+                self.remaining[(key_index, resource)] = int(remaining)
+            if reset is not None:
+                self.reset_at[(key_index, resource)] = float(reset)
+            if retry_after is not None:
+                self.blocked_until[key_index] = time.time() + float(retry_after)
+            self._key_available.notify_all()
+
+    def _is_rate_limited(self, response):
+        if response.status_code not in (403, 429):
+            return False
+        return (response.headers.get('X-RateLimit-Remaining') == '0'
+                or 'Retry-After' in response.headers
+                or 'rate limit' in response.text.lower())
+
+    def make_request(self, url, params=None, max_retries=3, json_body=None):
+        data, _ = self.make_request_with_links(url, params, max_retries, json_body)
+        return data
+
+    def make_request_with_links(self, url, params=None, max_retries=3, json_body=None, raise_errors=False):
+        # Returns the decoded body and the pagination links (rel -> url) of the response
+        # Rate limited responses are retried until they succeed and do not count as attempts,
+        # server errors and connection errors are retried max_retries times
+        # A json_body turns the call into an uncached POST (used for GraphQL queries)
+        # A failed request returns (None, {}), or raises GitHubAPIError with raise_errors
+        def fail(message, status_code=None):
+            print(message)
+            if raise_errors:
+                raise GitHubAPIError(message, status_code)
+            return None, {}
+
+        # Budget the request is counted against, GraphQL having its own
+        resource = "graphql" if url == GITHUB_GRAPHQL_URL else "core"
+        attempt = 0
+        error = None
+        while attempt < max_retries:
+            key_index = self._acquire_key(resource)
+            if key_index is None:
+                return fail("No valid API key available")
+
             try:
-                response = requests.get(url, headers=self._get_headers(), params=params)
-                
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 403:
-                    if 'rate limit' in response.text.lower():
-                        print(f"Rate limit reached for key {self.current_key_index + 1}")
-                        self._rotate_key()
-                        time.sleep(1)
-                        continue
+                if json_body is not None:
+                    cached = None
+                    response = self.sessions[key_index].post(url, params=params, json=json_body)
+                else:
+                    cached = self.cache.get(url, params) if self.cache else None
+                    headers = self.cache.conditional_headers(cached) if cached else {}
+                    response = self.sessions[key_index].get(url, params=params, headers=headers)
+                self._update_rate_limit(key_index, response, resource)
+
+                if response.status_code == 304 and cached:
+                    # Not modified: served from the cache, does not count against the rate limit
+                    return json.loads(cached['body']), self._parse_links(cached['link'])
+                elif response.status_code == 200:
+                    if self.cache and json_body is None:
+                        self.cache.put(url, params, response.content,
+                                       etag=response.headers.get('ETag'),
+                                       last_modified=response.headers.get('Last-Modified'),
+                                       link=response.headers.get('Link'))
+                    return response.json(), self._parse_links(response.headers.get('Link'))
+                elif self._is_rate_limited(response):
+                    print(f"Rate limit reached for key {key_index + 1}")
+                    if 'Retry-After' not in response.headers:
+                        budget = (key_index, response.headers.get('X-RateLimit-Resource', resource))
+                        with self._key_available:
+                            if self.remaining.get(budget) == 0:
+                                # Only this budget is exhausted, the key keeps serving the other one
+                                # Wait at least a second so a small clock skew does not make us hammer the API
+                                self.reset_at[budget] = max(self.reset_at.get(budget, 0.0), time.time() + 1)
+                            else:
+                                # Secondary rate limit without any hint, back off this key for a minute
+                                wait_until = time.time() + SECONDARY_RATE_LIMIT_WAIT
+                                self.blocked_until[key_index] = max(self.blocked_until[key_index], wait_until)
+                    continue
                 elif response.status_code == 401:
-                    print(f"Invalid key {self.current_key_index + 1}")
-                    self._rotate_key()
+                    print(f"Invalid key {key_index + 1}")
+                    self._invalidate_key(key_index)
+                    continue
+                elif response.status_code >= 500:
+                    # Usually transient, retried like a connection error
+                    error = (f"HTTP Error {response.status_code}: {response.text}", response.status_code)
+                    print(error[0])
+                    attempt += 1
+                    if attempt < max_retries:
+                        time.sleep(2)
                     continue
                 else:
-                    print(f"HTTP Error {response.status_code}: {response.text}")
-                    return None
-                    
+                    return fail(f"HTTP Error {response.status_code}: {response.text}", response.status_code)
+
+            except GitHubAPIError:
+                raise
             except Exception as e:
-                print(f"Request error: {e}")
-                if attempt < max_retries - 1:
+                error = (f"Request error: {e}", None)
+                print(error[0])
+                attempt += 1
+                if attempt < max_retries:
                     time.sleep(2)
-                    continue
-                return None
-        
-        return None
+                continue
+
+            finally:
+                self._release_key(key_index)
+
+        message, status_code = error or ("no attempt made", None)
+        return fail(f"Giving up on {url} after {max_retries} attempts, last error: {message}", status_code)
+
+    def _parse_links(self, link_header):
+        if not link_header:
+            return {}
+        return {link['rel']: link['url'] for link in requests.utils.parse_header_links(link_header) if 'rel' in link}
+
+    def iter_pages(self, url, params=None):
+        # Follow the Link: rel="next" headers, yielding the body of every page
+        # A page that cannot be fetched raises GitHubAPIError, so a truncated listing never looks complete
+        while url:
+            data, links = self.make_request_with_links(url, params, raise_errors=True)
+            yield data
+            # The next url already carries the query string
+            url = links.get('next')
+            params = None
+
+    def make_graphql_request(self, query, variables=None, max_retries=3):
+        data = self.make_request(GITHUB_GRAPHQL_URL, max_retries=max_retries,
+                                 json_body={'query': query, 'variables': variables or {}})
+        if data is None:
+            return None
+        if data.get('errors'):
+            print(f"GraphQL Error: {data['errors']}")
+        return data.get('data')
+
+    def make_requests(self, urls, params=None):
+        """
+        Run several requests in parallel across all the API keys.
+        Results are returned in the same order as urls.
+        """
+        if params is None:
+            params = [None] * len(urls)
+        max_workers = max(1, len(self.api_keys) * self.max_in_flight_per_key)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.make_request, urls, params))
 
-github_api = GitHubAPIManager()
\ No newline at end of file
+github_api = GitHubAPIManager()
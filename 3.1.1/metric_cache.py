@@ -0,0 +1,53 @@
+import json
+import os
+import sqlite3
+import threading
+
+DEFAULT_METRIC_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "metrics.sqlite")
+
+class MetricCache:
+    """
+    Metrics of Puppet manifests keyed by git blob SHA, so a file already analyzed in any repository
+    or in a previous run is never analyzed again.
+    Entries are only valid for the analyzer version that computed them.
+    """
+    def __init__(self, analyzer_version, path=DEFAULT_METRIC_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.analyzer_version = analyzer_version
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS metrics ("
+            " blob_sha TEXT NOT NULL, analyzer_version INTEGER NOT NULL, metrics TEXT NOT NULL,"
+            " PRIMARY KEY (blob_sha, analyzer_version))"
+        )
+        self._conn.commit()
+
+    def get_many(self, blob_shas):
+        # Returns the cached metrics of the given blobs, as a dict blob_sha -> metrics
+        blob_shas = list(set(blob_shas))
+        found = {}
+        with self._lock:
+            # Bounded number of parameters per query
+            for i in range(0, len(blob_shas), 500):
+                chunk = blob_shas[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT blob_sha, metrics FROM metrics WHERE analyzer_version = ?"
+                    f" AND blob_sha IN ({', '.join('?' * len(chunk))})",
+                    (self.analyzer_version, *chunk)
+                ).fetchall()
+                found.update((blob_sha, json.loads(metrics)) for blob_sha, metrics in rows)
+        return found
+
+    def put_many(self, metrics_by_sha):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO metrics (blob_sha, analyzer_version, metrics) VALUES (?, ?, ?)",
+                [(blob_sha, self.analyzer_version, json.dumps(metrics)) for blob_sha, metrics in metrics_by_sha.items()]
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
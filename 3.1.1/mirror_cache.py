@@ -0,0 +1,160 @@
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+DEFAULT_MIRROR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "mirrors")
+# Disk space the mirrors may take before the least recently used ones are evicted
+DEFAULT_QUOTA_MB = 20480
+# Mirrors fetched less than this many seconds ago are used without fetching again
+FETCH_MAX_AGE = 3600
+
+class MirrorCache:
+    """
+    Persistent bare mirrors of the analyzed repositories, keyed by clone URL.
+    A repository is cloned once and then only fetched, the least recently used mirrors
+    are deleted when the store grows over its quota.
+    Every mirror has a lock file: readers share it, updates and evictions take it exclusively,
+    so workers of the same or of different processes can use the store at the same time.
+    clone_slots, a context manager entered around every clone and fetch, can limit how many
+    of them run at the same time.
+    """
+    def __init__(self, root=DEFAULT_MIRROR_DIR, quota_mb=DEFAULT_QUOTA_MB, max_age=FETCH_MAX_AGE, clone_slots=None):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.quota = quota_mb * 1024 * 1024
+        self.max_age = max_age
+        self.clone_slots = clone_slots or nullcontext()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS mirrors ("
+            " clone_url TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL,"
+            " fetched_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def mirror_path(self, clone_url):
+        name = re.sub(r"[^\w.-]", "_", clone_url.rstrip("/").split("/")[-1])
+        if not name.endswith(".git"):
+            name += ".git"
+        digest = hashlib.sha256(clone_url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.root, f"{digest}-{name}")
+
+    @contextmanager
+    def mirror(self, clone_url):
+        """
+        Yield the git dir of an up to date mirror of clone_url, kept on disk until the block exits.
+        Raises subprocess.CalledProcessError if the repository cannot be cloned or fetched.
+        """
+        path = self.mirror_path(clone_url)
+        requested_at = time.time()
+        with open(path + ".lock", "a") as lock_file:
+            while True:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                if self._fetched_since(clone_url, path, requested_at - self.max_age):
+                    break
+                # Stale or missing: update it alone, then come back as a reader
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if not self._fetched_since(clone_url, path, requested_at - self.max_age):
+                        with self.clone_slots:
+                            self._update(clone_url, path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                self._evict(keep=clone_url)
+
+            try:
+                with self._lock:
+                    self._conn.execute("UPDATE mirrors SET last_used = ? WHERE clone_url = ?", (time.time(), clone_url))
+                    self._conn.commit()
+                yield path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fetched_since(self, clone_url, path, since):
+        with self._lock:
+            row = self._conn.execute("SELECT fetched_at FROM mirrors WHERE clone_url = ?", (clone_url,)).fetchone()
+        return row is not None and row[0] >= since and os.path.isdir(path)
+
+    def _update(self, clone_url, path):
+        # Never ask for credentials on a private or deleted repository
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        if os.path.isdir(path):
+            subprocess.run(
+                ["git", "--git-dir", path, "fetch", "--prune", "--tags", "origin", "+refs/heads/*:refs/heads/*"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True, env=env
+            )
+        else:
+            # Cloned aside then renamed, so an interrupted clone never looks like a mirror
+            tmp_path = tempfile.mkdtemp(dir=self.root, prefix=".clone-")
+            try:
+                subprocess.run(
+                    ["git", "clone", "--bare", clone_url, tmp_path],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True, env=env
+                )
+                os.rename(tmp_path, path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        # Commit graph of the mirror, so history walks do not parse every commit again
+        subprocess.run(
+            ["git", "--git-dir", path, "commit-graph", "write", "--reachable"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True
+        )
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO mirrors (clone_url, path, size, fetched_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (clone_url, path, directory_size(path), now, now)
+            )
+            self._conn.commit()
+
+    def _evict(self, keep):
+        with self._lock:
+            rows = self._conn.execute("SELECT clone_url, path, size FROM mirrors ORDER BY last_used").fetchall()
+        total = sum(size for _, _, size in rows)
+
+        for clone_url, path, size in rows:
+            if total <= self.quota:
+                break
+            if clone_url == keep:
+                continue
+            with open(path + ".lock", "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # In use by another worker, try the next one
+                    continue
+                try:
+                    shutil.rmtree(path, ignore_errors=True)
+                    with self._lock:
+                        self._conn.execute("DELETE FROM mirrors WHERE clone_url = ?", (clone_url,))
+                        self._conn.commit()
+                    total -= size
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
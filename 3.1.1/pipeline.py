@@ -1,53 +1,193 @@
-import subprocess
+import argparse
+import csv
+import importlib
+import shutil
 import sys
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse
+from stage_runner import script_stage, run_stages
+from repo_stream import RepoStage, stream_repos
+from github_api_manager import github_api, MAX_IN_FLIGHT_PER_KEY
+from mirror_cache import MirrorCache, DEFAULT_QUOTA_MB
+from activity_cache import ActivityCache
+from metric_cache import MetricCache
 
-def run_script(script_name, args=None):
-    cmd = ["python", script_name]
-    if args:
-        cmd.extend(args)
-    
-    try:
-        subprocess.run(cmd, check=True)
-        print(f"{script_name} completed successfully")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error in {script_name}: {e}")
-        return False
+check_repos = importlib.import_module("1_check_repos")
+filter_iac = importlib.import_module("2_filter_iac")
+filter_activity = importlib.import_module("3_filter_activity")
+analyze_iac = importlib.import_module("4_analyze_iac")
+
+# Repositories kept by stage 2 are cloned once in persistent mirrors shared by stages 3 and 4
+MIRROR_DIR = "3.1.1/cache/mirrors"
 
 def get_org_name_from_url(url):
     path_parts = urlparse(url).path.strip("/").split("/")
     return path_parts[0] if path_parts else "org"
 
+def org_outputs(org_name):
+    # Output files of the four steps for an organization
+    return (f"3.1.1/downloadable/repos_{org_name}.csv",
+            f"3.1.1/iac_filter/iac_repos_{org_name}.csv",
+            f"3.1.1/activity/iac_repos_active_{org_name}.csv",
+            f"3.1.1/final/defects_{org_name}.csv")
+
+def csv_output(path, header):
+    # Output file of a streamed step, flushed after every row so results can be followed while it runs
+    f = open(path, "w", newline="", encoding="utf-8")
+    writer = csv.writer(f)
+    writer.writerow(header)
+
+    def write(rows):
+        writer.writerows(rows)
+        f.flush()
+    return f, write
+
+def write_kept(writes, step):
+    # Write callback of a filtering step: the repositories it keeps, as its script writes them
+    def write_row(row, keep):
+        if keep:
+            writes[row["org"]][step]([[row["name"], row["clone_url"]]])
+    return write_row
+
+def list_repos(orgs):
+    # Repositories of every organization, the next organization being listed once these are queued
+    for github_url, org_name in orgs:
+        try:
+            repos = check_repos.get_repos(github_url)
+        except Exception as e:
+            # The other organizations go on, this one keeps empty outputs
+            traceback.print_exc()
+            print(f"Error listing the repositories of {org_name}: {e}")
+            continue
+        print(f"{org_name}: {len(repos)} repositories listed")
+        for repo in repos:
+            yield {"org": org_name, "name": repo["name"], "clone_url": repo["clone_url"]}
+
+def stream_pipeline(orgs, mirror_dir=MIRROR_DIR, mirror_quota_mb=DEFAULT_QUOTA_MB, max_clones=filter_iac.MAX_CLONES,
+                    min_free_mb=filter_iac.MIN_FREE_TEMP_MB, processes=None):
+    """
+    Run the four steps on the (github_url, org_name) organizations, every repository moving through them
+    on its own as soon as it is listed: the first rows of the final outputs are written while the other
+    repositories are still being checked. Each output keeps the input order and the content written
+    by the steps run one after the other.
+    All the organizations share the threads of every step, the process pool of the analysis, the caches
+    and the mirrors, with at most max_clones clones or fetches at the same time, waiting while less than
+    min_free_mb are free in the mirror directory.
+    """
+    clone_slots = filter_iac.CloneSlots(max_clones, mirror_dir, min_free_mb)
+    mirrors = MirrorCache(mirror_dir, mirror_quota_mb, clone_slots=clone_slots)
+    activity_cache = ActivityCache()
+    metric_cache = MetricCache(analyze_iac.ANALYZER_VERSION)
+    temp_dir = tempfile.mkdtemp()
+
+    def check(row):
+        clonable = check_repos.check_clonable(row["clone_url"])
+        print(f"{row['name']}: {'clonable' if clonable else 'not clonable'}")
+        return clonable
+
+    def filter_ratio(row):
+        total, iac, ratio = filter_iac.process_repo(row["clone_url"], clone_slots=clone_slots)
+        keep = ratio >= filter_iac.MIN_IAC_RATIO
+        print(f"{row['name']}: {iac}/{total} IaC files ({round(ratio, 2)}%) -> {'keep' if keep else 'discard'}")
+        return keep
+
+    def is_active(row):
+        return filter_activity.is_active_repo(row["clone_url"], mirrors=mirrors, cache=activity_cache)
+
+    # Write functions of the four outputs of every organization
+    writes = {}
+    outputs = []
+    try:
+        for _, org_name in orgs:
+            headers = [["name", "clone_url"]] * 3 + [analyze_iac.FIELDNAMES]
+            writes[org_name] = []
+            for path, header in zip(org_outputs(org_name), headers):
+                f, write = csv_output(path, header)
+                outputs.append(f)
+                writes[org_name].append(write)
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            analyze_iac.start_workers(pool)
+
+            def analyze(row):
+                repo = analyze_iac.checkout_repository(row["clone_url"], temp_dir, mirrors, metric_cache)
+                if repo is None:
+                    print(f"  → Error cloning {row['name']}")
+                    return []
+                rows = analyze_iac.repository_rows(pool, row["org"], row["name"], repo, cache=metric_cache)
+                print(f"  → {row['name']}: {len(rows)} IaC files analyzed")
+                return rows
+
+            def write_rows(row, rows):
+                writes[row["org"]][3]([[r[field] for field in analyze_iac.FIELDNAMES] for r in rows])
+
+            stages = [
+                RepoStage("1_check_repos", check, check_repos.WORKERS, write=write_kept(writes, 0)),
+                RepoStage("2_filter_iac", filter_ratio, filter_iac.WORKERS, write=write_kept(writes, 1)),
+                RepoStage("3_filter_activity", is_active, filter_activity.WORKERS, write=write_kept(writes, 2)),
+                RepoStage("4_analyze_iac", analyze, analyze_iac.CLONE_WORKERS, write=write_rows)
+            ]
+            # Every organization keeps its own order, without waiting for the others
+            stream_repos(list_repos(orgs), stages, group=lambda row: row["org"])
+    finally:
+        for f in outputs:
+            f.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python pipeline.py <GitHub user/org URL>")
-        sys.exit(1)
-    
-    github_url = sys.argv[1]
-    org_name = get_org_name_from_url(github_url)
-    
-    repos_csv = f"3.1.1/downloadable/repos_{org_name}.csv"
-    iac_csv = f"3.1.1/iac_filter/iac_repos_{org_name}.csv"
-    iac_active_csv = f"3.1.1/activity/iac_repos_active_{org_name}.csv"
-    final_csv = f"3.1.1/final/defects_{org_name}.csv"
-    
-    scripts = [
-        ("3.1.1/1_check_repos.py", [github_url, "--out", repos_csv]),
-        ("3.1.1/2_filter_iac.py", ["--in", repos_csv, "--out", iac_csv]),
-        ("3.1.1/3_filter_activity.py", ["--in", iac_csv, "--out", iac_active_csv]),
-        ("3.1.1/4_analyze_iac.py", ["--in", iac_active_csv, "--out", final_csv, "--org", org_name])
-    ]
-    
+    parser = argparse.ArgumentParser(description="Run the 3.1.1 pipeline on the repositories of GitHub users/orgs")
+    parser.add_argument("urls", nargs="+", metavar="url",
+                        help="GitHub user/org URL, several organizations are streamed together (see --streaming)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Move every repository through the four steps on its own instead of "
+                             "running each step on all of them before the next one")
+    parser.add_argument("--max-clones", type=int, default=filter_iac.MAX_CLONES,
+                        help=f"Clones and fetches running at the same time, for all the organizations (default: {filter_iac.MAX_CLONES})")
+    parser.add_argument("--min-free-mb", type=int, default=filter_iac.MIN_FREE_TEMP_MB,
+                        help=f"Free space to keep where repositories are cloned, in MB (default: {filter_iac.MIN_FREE_TEMP_MB})")
+    parser.add_argument("--mirror-quota-mb", type=int, default=DEFAULT_QUOTA_MB,
+                        help=f"Disk space of the mirrors before the least recently used are evicted (default: {DEFAULT_QUOTA_MB})")
+    parser.add_argument("--api-calls-per-key", type=int, default=MAX_IN_FLIGHT_PER_KEY,
+                        help=f"GitHub API requests in flight at the same time for each API key (default: {MAX_IN_FLIGHT_PER_KEY})")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Processes analyzing the manifests (default: number of CPUs)")
+    args = parser.parse_args()
+
+    # An organization given twice would write the same files
+    orgs = list(dict.fromkeys((url, get_org_name_from_url(url)) for url in args.urls))
+    github_api.set_max_in_flight_per_key(args.api_calls_per_key)
+
     print("Starting the GitHub repos processing pipeline")
-    print(f"Target URL: {github_url}")
+    for github_url, _ in orgs:
+        print(f"Target URL: {github_url}")
     print("-" * 50)
-    
-    for script_name, args in scripts:
-        print(f"Running {script_name}...")
-        if not run_script(script_name, args):
-            print(f"Stopping the pipeline due to error in {script_name}")
+
+    if args.streaming or len(orgs) > 1:
+        stream_pipeline(orgs, MIRROR_DIR, args.mirror_quota_mb, args.max_clones, args.min_free_mb, args.processes)
+    else:
+        github_url, org_name = orgs[0]
+        repos_csv, iac_csv, iac_active_csv, final_csv = org_outputs(org_name)
+        mirror_args = ["--mirror-dir", MIRROR_DIR, "--mirror-quota-mb", str(args.mirror_quota_mb)]
+
+        # Every stage runs in this process, as soon as the stage writing its input is done
+        stages = [
+            script_stage("3.1.1/1_check_repos.py", [github_url, "--out", repos_csv],
+                         outputs=[repos_csv]),
+            script_stage("3.1.1/2_filter_iac.py", ["--in", repos_csv, "--out", iac_csv,
+                                                   "--max-clones", str(args.max_clones), "--min-free-mb", str(args.min_free_mb)],
+                         inputs=[repos_csv], outputs=[iac_csv]),
+            script_stage("3.1.1/3_filter_activity.py", ["--in", iac_csv, "--out", iac_active_csv, *mirror_args],
+                         inputs=[iac_csv], outputs=[iac_active_csv]),
+            script_stage("3.1.1/4_analyze_iac.py", ["--in", iac_active_csv, "--out", final_csv, "--org", org_name, *mirror_args,
+                                                    *(["--processes", str(args.processes)] if args.processes else [])],
+                         inputs=[iac_active_csv], outputs=[final_csv])
+        ]
+
+        failed = run_stages(stages)
+        if failed:
+            print(f"Stopping the pipeline due to error in {failed[0]}")
             sys.exit(1)
-        print()
-    
+
     print("Pipeline completed")
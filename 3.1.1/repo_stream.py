@@ -0,0 +1,117 @@
+import queue
+import threading
+import traceback
+
+# Repositories waiting in front of a stage, per thread of the stage
+QUEUE_SIZE_PER_WORKER = 2
+# Marks the end of the repositories in the queue of a stage
+END = None
+
+class RepoStage:
+    """
+    Step applied to every repository on its own by a pool of threads.
+    process(row) returns the result of the repository, which goes on to the next stage if keep(result)
+    is true. write(row, result) is called in input order for every repository the stage processed,
+    as soon as all the previous ones are written.
+    """
+    def __init__(self, name, process, workers, keep=bool, write=None):
+        self.name = name
+        self.process = process
+        self.workers = workers
+        self.keep = keep
+        self.write = write
+
+class OrderedWrites:
+    """
+    Calls write(row, result) in input order. Results arrive in any order and wait until every previous
+    repository is known, rows set to None are repositories dropped by a previous stage.
+    A write that raises is reported and skipped, the next repositories are still written.
+    """
+    def __init__(self, write):
+        self.write = write
+        self._lock = threading.Lock()
+        self._results = {}
+        self._next_index = 0
+
+    def add(self, index, row, result):
+        with self._lock:
+            self._results[index] = (row, result)
+            while self._next_index in self._results:
+                row, result = self._results.pop(self._next_index)
+                self._next_index += 1
+                if row is not None and self.write:
+                    try:
+                        self.write(row, result)
+                    except Exception as e:
+                        traceback.print_exc()
+                        print(f"Error writing the result of {row['name']}: {e}")
+
+def stream_repos(rows, stages, group=None):
+    """
+    Move every repository through the stages on its own: it enters a stage as soon as the previous
+    one is done with it, through bounded queues, so every stage works on different repositories at
+    the same time and the first results are out long before the last repository is listed.
+    With group, a function of the row, writes keep the input order within each group only,
+    so repositories of different groups (e.g. organizations) never wait for each other.
+    A repository whose stage raises is dropped.
+    """
+    queues = [queue.Queue(maxsize=stage.workers * QUEUE_SIZE_PER_WORKER) for stage in stages]
+    # Ordered writes of every stage, by group
+    writes = [{} for _ in stages]
+    running = [stage.workers for stage in stages]
+    lock = threading.Lock()
+
+    def work(k):
+        stage = stages[k]
+        next_queue = queues[k + 1] if k + 1 < len(stages) else None
+        try:
+            while True:
+                item = queues[k].get()
+                if item is END:
+                    break
+                # Dropped repositories still go through, so the next stages know not to wait for them
+                key, index, row = item
+                result, keep = None, False
+                try:
+                    if row is not None:
+                        try:
+                            result = stage.process(row)
+                            keep = stage.keep(result)
+                        except Exception as e:
+                            traceback.print_exc()
+                            print(f"Error in {stage.name} for {row['name']}: {e}")
+                    writes[k][key].add(index, row, result)
+                finally:
+                    # Whatever happens, the next stage hears about the repository and does not wait for it
+                    if next_queue is not None:
+                        next_queue.put((key, index, row if keep else None))
+        finally:
+            # The last thread of a stage to finish ends the next one, even if this one died
+            with lock:
+                running[k] -= 1
+                last = running[k] == 0
+            if last and next_queue is not None:
+                for _ in range(stages[k + 1].workers):
+                    next_queue.put(END)
+
+    threads = [threading.Thread(target=work, args=(k,), daemon=True)
+               for k, stage in enumerate(stages) for _ in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+
+    counts = {}
+    try:
+        for row in rows:
+            key = group(row) if group else None
+            if key not in counts:
+                counts[key] = 0
+                for k, stage in enumerate(stages):
+                    writes[k][key] = OrderedWrites(stage.write)
+            queues[0].put((key, counts[key], row))
+            counts[key] += 1
+    finally:
+        # Even when listing the repositories fails, the ones already queued are finished
+        for _ in range(stages[0].workers):
+            queues[0].put(END)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "github_api.sqlite")
+
+class ResponseCache:
+    """
+    On-disk cache of GitHub API responses.
+    Bodies are stored once per content hash, requests point to the body they last returned
+    together with the ETag/Last-Modified validators used to revalidate them.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bodies (body_hash TEXT PRIMARY KEY, body BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " request_key TEXT PRIMARY KEY, url TEXT NOT NULL, etag TEXT, last_modified TEXT,"
+            " link TEXT, body_hash TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def request_key(url, params=None):
+        params = sorted((str(k), str(v)) for k, v in (params or {}).items())
+        return hashlib.sha256(json.dumps([url, params]).encode("utf-8")).hexdigest()
+
+    def get(self, url, params=None):
+        # Returns the cached entry of a request as a dict, or None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT r.etag, r.last_modified, r.link, b.body FROM responses r"
+                " JOIN bodies b ON b.body_hash = r.body_hash WHERE r.request_key = ?",
+                (self.request_key(url, params),)
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, link, body = row
+        return {"etag": etag, "last_modified": last_modified, "link": link, "body": body}
+
+    def put(self, url, params, body, etag=None, last_modified=None, link=None):
+        if not etag and not last_modified:
+            # Nothing to revalidate with, caching would only serve stale data
+            return
+        body_hash = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO bodies (body_hash, body) VALUES (?, ?)", (body_hash, body)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (request_key, url, etag, last_modified, link, body_hash, fetched_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.request_key(url, params), url, etag, last_modified, link, body_hash, time.time())
+            )
+            self._conn.commit()
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,81 @@
+import importlib
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Stage:
+    """
+    Step of a pipeline run in the pipeline process. A stage declares the files it reads and writes:
+    it starts as soon as every stage writing one of its inputs has completed.
+    """
+    def __init__(self, name, run, inputs=(), outputs=()):
+        self.name = name
+        self.run = run
+        self.inputs = [os.path.normpath(path) for path in inputs]
+        self.outputs = [os.path.normpath(path) for path in outputs]
+
+def script_stage(script, argv, inputs=(), outputs=()):
+    # Stage calling main(argv) of one of the step scripts, imported once by the pipeline process
+    # The directory of the script must be on sys.path, as it is for the scripts next to it
+    module = importlib.import_module(os.path.splitext(os.path.basename(script))[0])
+    return Stage(script, lambda: module.main(argv), inputs, outputs)
+
+def run_stage(stage):
+    # True if the stage completed, a stage fails by raising or by exiting with a non-zero status
+    try:
+        stage.run()
+        return True
+    except SystemExit as e:
+        if e.code in (None, 0):
+            return True
+        print(f"Error in {stage.name}: exit status {e.code}")
+    except Exception as e:
+        traceback.print_exc()
+        print(f"Error in {stage.name}: {e}")
+    return False
+
+def run_stages(stages):
+    """
+    Run the stages in the current process, each one as soon as the stages writing its inputs have
+    completed, so independent stages run at the same time. Inputs written by no stage must already exist.
+    When a stage fails, the stages depending on it, directly or not, are not run.
+    Returns the names of the stages that failed or were not run, empty if the whole pipeline completed.
+    """
+    writers = {path: stage for stage in stages for path in stage.outputs}
+    dependencies = {stage: {writers[path] for path in stage.inputs if path in writers} - {stage} for stage in stages}
+
+    waiting = list(stages)
+    completed, failed = set(), []
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        running = {}
+        while waiting or running:
+            # Stages given up may in turn give up stages listed before them
+            progress = True
+            while progress:
+                progress = False
+                for stage in list(waiting):
+                    if any(dependency in failed for dependency in dependencies[stage]):
+                        print(f"Not running {stage.name}, one of its inputs could not be produced")
+                        waiting.remove(stage)
+                        failed.append(stage)
+                        progress = True
+                    elif dependencies[stage] <= completed:
+                        print(f"Running {stage.name}...")
+                        waiting.remove(stage)
+                        running[executor.submit(run_stage, stage)] = stage
+
+            if not running:
+                if waiting:
+                    raise ValueError(f"Circular inputs between {', '.join(stage.name for stage in waiting)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                if future.result():
+                    print(f"{stage.name} completed successfully")
+                    completed.add(stage)
+                else:
+                    failed.append(stage)
+
+    return [stage.name for stage in failed]
@@ -0,0 +1,115 @@
+import os
+import subprocess
+import pandas as pd
+
+# Local clones used by the git backend, kept between runs so only new commits are fetched,
+# next to this file whatever the working directory
+CLONES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clones")
+GIT_BASE_URL = "https://github.com/"
+COMMITS_PER_BATCH = 1000
+
+def clone_or_update_repo(org_name, repo_name, clones_dir=CLONES_DIR, base_url=GIT_BASE_URL):
+    """
+    Bare, blobless clone of a repository (commits and trees only), or fetch of the new commits
+    if the clone already exists. Returns the path of the clone, or None if git failed.
+    """
+    repo_path = os.path.join(clones_dir, org_name, f"{repo_name}.git")
+    clone_url = f"{base_url}{org_name}/{repo_name}.git"
+
+    try:
+        if os.path.isdir(repo_path):
+            subprocess.run(
+                ["git", "--git-dir", repo_path, "fetch", "--prune", "origin", "+refs/heads/*:refs/heads/*"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True
+            )
+        else:
+            os.makedirs(os.path.dirname(repo_path), exist_ok=True)
+            subprocess.run(
+                ["git", "clone", "--bare", "--filter=blob:none", clone_url, repo_path],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True
+            )
+        return repo_path
+    except subprocess.CalledProcessError as e:
+        print(f"Git error for {clone_url}: {e.stderr.strip()}")
+        return None
+
+def iter_commits_with_files(repo_path):
+    """
+    Stream (sha, message, changed files) for every commit of the default branch, newest first,
+    from a single git log pass. Merge commits list the files changed against their first parent,
+    like the GitHub API does.
+    Raises subprocess.CalledProcessError if git log fails, so a corrupt clone never looks like a complete history.
+    """
+    # Fields are separated by NUL bytes, which cannot appear in a commit message
+    process = subprocess.Popen(
+        ["git", "-c", "core.quotePath=false", "--git-dir", repo_path, "log",
+         "--no-renames", "--diff-merges=first-parent", "--name-only", "--format=%x00%H%x00%B%x00"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding="utf-8", errors="replace"
+    )
+
+    buffer = None
+    fields = []
+    try:
+        for chunk in iter(lambda: process.stdout.read(65536), ""):
+            if buffer is None:
+                # The output starts with a separator, skip the empty field before it
+                buffer = chunk[1:]
+            else:
+                buffer += chunk
+            *complete, buffer = buffer.split("\0")
+            fields.extend(complete)
+            # Every commit is made of its sha, message and file list
+            while len(fields) >= 3:
+                sha, message, files = fields[:3]
+                del fields[:3]
+                yield sha, message.strip(), [line for line in files.splitlines() if line]
+
+        # The file list of the last commit is not followed by a separator
+        if buffer is not None and len(fields) == 2:
+            sha, message = fields
+            yield sha, message.strip(), [line for line in buffer.splitlines() if line]
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+    finally:
+        process.stdout.close()
+        process.wait()
+
+def iter_repo_commits_and_files(org_name, repo_name, batch_size=COMMITS_PER_BATCH):
+    """
+    Local git counterpart of the API extraction: yields batches of commits dataframes
+    together with the list of changed IaC files dataframes, in the same order.
+    """
+    print(f"Processing repository: {repo_name}")
+
+    repo_path = clone_or_update_repo(org_name, repo_name)
+    if repo_path is None:
+        return
+
+    commits_messages = []
+    commits_shas = []
+    files_from_commits = []
+    for sha, message, files in iter_commits_with_files(repo_path):
+        # We assume that IAC files are only .pp files (based on previous analysis)
+        iac_files = [file_name for file_name in files if ".pp" in file_name]
+        if not iac_files:
+            continue
+
+        commits_messages.append(message)
+        commits_shas.append(sha)
+        files_from_commits.append(pd.DataFrame({'file_name': iac_files}))
+
+        if len(commits_shas) >= batch_size:
+            yield commits_dataframe(repo_name, commits_messages, commits_shas), files_from_commits
+            commits_messages = []
+            commits_shas = []
+            files_from_commits = []
+
+    if commits_shas:
+        yield commits_dataframe(repo_name, commits_messages, commits_shas), files_from_commits
+
+def commits_dataframe(repo_name, commits_messages, commits_shas):
+    return pd.DataFrame({
+        'repo_name': [repo_name] * len(commits_shas),
+        'commit_message': commits_messages,
+        'commit_sha': commits_shas
+    })
@@ -1,35 +1,74 @@
 import pandas as pd
 import sys
+import itertools
 from pathlib import Path
 module_path = Path(__file__).resolve().parent.parent / "3.1.1"
 sys.path.append(str(module_path))
-from github_api_manager import github_api
+from github_api_manager import github_api, GitHubAPIError
 
-def repo_commits_extraction(org_url, repo_name):
+# Number of commits returned per page by the API, and per batch by iter_repo_commits
+COMMITS_PER_PAGE = 100
+COMMITS_PER_BATCH = 1000
 
+def iter_repo_commits(org_url, repo_name, since=None, until=None, path=None, batch_size=COMMITS_PER_BATCH):
+    """
+    Stream the whole commit history of a repository, following the API pagination.
+    since/until are ISO 8601 dates and path restricts the history to a file or a directory.
+    Yields dataframes of at most batch_size commits, so memory stays bounded on large repositories.
+    Raises GitHubAPIError when a page cannot be fetched, instead of ending with a truncated history.
+    """
     print(f"Processing repository: {repo_name}")
 
     # Repositories identification
     url_repo_commits = f"{org_url}{repo_name}/commits"
+    params = {"per_page": COMMITS_PER_PAGE}
+    if since:
+        params["since"] = since
+    if until:
+        params["until"] = until
+    if path:
+        params["path"] = path
 
-    # GitHub API Call
-    data = github_api.make_request(url_repo_commits)
+    pages = github_api.iter_pages(url_repo_commits, params=params)
+    try:
+        first_page = next(pages, [])
+    except GitHubAPIError as e:
+        # Deleted (404) and empty (409) repositories have no history, any other error fails the repository
+        if e.status_code not in (404, 409):
+            raise
+        print(f"No commit history for {repo_name}")
+        return
 
-    # Checking request success
-    if data:
-
-        # Commit messages and SHAs extraction
-        commits_messages = []
-        commits_shas = []
+    # Commit messages and SHAs extraction, page after page
+    commits_messages = []
+    commits_shas = []
+    for data in itertools.chain([first_page], pages):
         for commit in data:
             commits_messages.append(f"{commit['commit']['message'].strip()}")
             commits_shas.append(f"{commit['sha']}")
 
-        commits_df = pd.DataFrame(columns=['repo_name', 'commit_message', 'commit_sha'])
-        for message, sha in zip(commits_messages, commits_shas):
-            commits_df.loc[len(commits_df)] = [repo_name, message, sha]
+        if len(commits_shas) >= batch_size:
+            yield commits_batch(repo_name, commits_messages, commits_shas)
+            commits_messages = []
+            commits_shas = []
+
+    if commits_shas:
+        yield commits_batch(repo_name, commits_messages, commits_shas)
 
-        return commits_df
+def commits_batch(repo_name, commits_messages, commits_shas):
+    return pd.DataFrame({
+        'repo_name': [repo_name] * len(commits_shas),
+        'commit_message': commits_messages,
+        'commit_sha': commits_shas
+    })
+
+def repo_commits_extraction(org_url, repo_name, since=None, until=None, path=None):
+
+    batches = list(iter_repo_commits(org_url, repo_name, since=since, until=until, path=path))
+
+    # Checking request success
+    if batches:
+        return pd.concat(batches, ignore_index=True)
 
 def files_from_commit_extraction(org_url, repo_name, commit_sha):
     
@@ -39,15 +78,139 @@ def files_from_commit_extraction(org_url, repo_name, commit_sha):
     # GiHub API Call
     data = github_api.make_request(url_repo_commits)
 
-    # Checking request success
+    return files_from_commit_data(data)
+
+def files_from_commits_extraction(org_url, repo_name, commit_shas):
+
+    # Commits identification
+    urls_repo_commits = [f"{org_url}{repo_name}/commits/{commit_sha}" for commit_sha in commit_shas]
+
+    # GitHub API Calls, sent in parallel across all API keys
+    data_list = github_api.make_requests(urls_repo_commits)
+
+    return [files_from_commit_data(data) for data in data_list]
+
+def files_from_commit_data(data):
+
+    # Checking request success: a failed request gives None, a commit without IaC files an empty dataframe
+    if data is None:
+        return None
+
+    # File names extraction from commit, the dataframe being built once
+    # We assume that IAC files are only .pp files (based on previous analysis)
+    file_names = [file['filename'].strip() for file in data.get("files", []) if ".pp" in file['filename']]
+
+    return pd.DataFrame({'file_name': file_names}, columns=['file_name'])
+
+
+# GraphQL backend: commit history and changed IaC files in large batches
+
+# Number of file histories fetched by a single GraphQL query
+GRAPHQL_PATHS_PER_QUERY = 20
+# Queries of a history page before giving up on it
+GRAPHQL_ATTEMPTS = 3
+
+class TruncatedTreeError(GitHubAPIError):
+    # The tree of the default branch is too large for the API, its list of IaC files would be incomplete
+    pass
+
+def iac_files_from_repo_extraction(org_url, repo_name):
+
+    # Every file of the default branch in a single recursive tree call
+    url_repo_tree = f"{org_url}{repo_name}/git/trees/HEAD"
+    data = github_api.make_request(url_repo_tree, params={"recursive": 1})
+
+    if data and data.get("truncated"):
+        raise TruncatedTreeError(f"Tree of {repo_name} truncated by the API")
     if data:
+        # We assume that IAC files are only .pp files (based on previous analysis)
+        return [entry['path'] for entry in data["tree"] if entry['type'] == "blob" and ".pp" in entry['path']]
 
-        # File names extraction from commit
-        files_from_commit_df = pd.DataFrame(columns=['file_name'])
-        for file in data["files"]:
-            # We assume that IAC files are only .pp files (based on previous analysis)
-            if ".pp" in file['filename']:
-                files_from_commit_df.loc[len(files_from_commit_df)] = [file['filename'].strip()]
+def build_history_query(nb_paths):
 
-        return files_from_commit_df
-    
+    # One aliased history connection per file, each with its own path and cursor variables
+    declarations = ", ".join(f"$path{i}: String!, $cursor{i}: String" for i in range(nb_paths))
+    histories = "\n".join(
+        f"h{i}: history(first: 100, path: $path{i}, after: $cursor{i}) "
+        "{ pageInfo { hasNextPage endCursor } nodes { oid message committedDate } }"
+        for i in range(nb_paths)
+    )
+    return f"""
+    query($owner: String!, $name: String!, {declarations}) {{
+      repository(owner: $owner, name: $name) {{
+        defaultBranchRef {{ target {{ ... on Commit {{
+          {histories}
+        }} }} }}
+      }}
+    }}
+    """
+
+def repo_commits_and_files_graphql_extraction(org_url, repo_name):
+    """
+    Commits touching the IaC files of a repository, with the IaC files each of them changed.
+    Only files still present on the default branch are followed: unlike the REST history, commits
+    that only changed deleted or renamed IaC files are missing.
+    Returns the commits dataframe and the list of changed files dataframes, in the same order.
+    Raises TruncatedTreeError when the tree of the default branch is too large to list its IaC files.
+    A failed query is sent again, GitHubAPIError is raised if it keeps failing. A file history the
+    response leaves null is asked again in a later query, and skipped with a message if it stays null.
+    """
+    print(f"Processing repository: {repo_name}")
+
+    owner = org_url.rstrip("/").split("/")[-1]
+    iac_paths = iac_files_from_repo_extraction(org_url, repo_name)
+    if iac_paths is None:
+        return None, None
+
+    commits = {}
+    # Files whose history still has pages to fetch, with their current cursor and the failed queries of that page
+    pending = [(path, None, 0) for path in iac_paths]
+    while pending:
+        batch, pending = pending[:GRAPHQL_PATHS_PER_QUERY], pending[GRAPHQL_PATHS_PER_QUERY:]
+        variables = {"owner": owner, "name": repo_name}
+        for i, (path, cursor, _) in enumerate(batch):
+            variables[f"path{i}"] = path
+            variables[f"cursor{i}"] = cursor
+
+        # GraphQL API Call
+        data = github_api.make_graphql_request(build_history_query(len(batch)), variables)
+        if data is None:
+            # Requeued rather than dropped: these pages were already taken out of pending
+            if any(failures + 1 >= GRAPHQL_ATTEMPTS for _, _, failures in batch):
+                raise GitHubAPIError(f"GraphQL history query of {repo_name} failed {GRAPHQL_ATTEMPTS} times")
+            pending.extend((path, cursor, failures + 1) for path, cursor, failures in batch)
+            continue
+        if not data["repository"] or not data["repository"]["defaultBranchRef"]:
+            print(f"Repository {repo_name} or its default branch not found")
+            return None, None
+        target = data["repository"]["defaultBranchRef"]["target"] or {}
+
+        for i, (path, cursor, failures) in enumerate(batch):
+            history = target.get(f"h{i}")
+            if history is None:
+                # Left null by a partial error of the query
+                if failures + 1 < GRAPHQL_ATTEMPTS:
+                    pending.append((path, cursor, failures + 1))
+                else:
+                    print(f"History of {path} in {repo_name} could not be fetched, its commits are skipped")
+                continue
+            for node in history["nodes"]:
+                commit = commits.setdefault(node["oid"], {
+                    "message": node["message"].strip(),
+                    "date": node["committedDate"],
+                    "files": []
+                })
+                commit["files"].append(path)
+            if history["pageInfo"]["hasNextPage"]:
+                pending.append((path, history["pageInfo"]["endCursor"], 0))
+
+    # Most recent commits first, as returned by the REST API
+    ordered_shas = sorted(commits, key=lambda sha: commits[sha]["date"], reverse=True)
+    commits_df = pd.DataFrame({
+        'repo_name': [repo_name] * len(ordered_shas),
+        'commit_message': [commits[sha]["message"] for sha in ordered_shas],
+        'commit_sha': ordered_shas
+    })
+    files_from_commits = [pd.DataFrame({'file_name': commits[sha]["files"]}) for sha in ordered_shas]
+
+    return commits_df, files_from_commits
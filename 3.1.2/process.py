@@ -1,32 +1,23 @@
-import subprocess
 import sys
-import time
+from pathlib import Path
+module_path = Path(__file__).resolve().parent.parent / "3.1.1"
+sys.path.append(str(module_path))
+from stage_runner import Stage, script_stage, run_stages
+import github_repos_extraction
 
-def run_script(script_name, args=None):
-    cmd = [sys.executable, script_name]
-    if args:
-        cmd.extend(args)
-    
-    try:
-        subprocess.run(cmd, check=True)
-        print(f"{script_name} completed successfully")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error in {script_name}: {e}")
-        return False
-    
 if __name__ == "__main__":
-    scripts = [
-        "3.1.2/github_repos_extraction.py",
-        "3.1.2/xcm_generator.py"
+    # Both steps run in this process, the XCM generation once the repositories are extracted
+    stages = [
+        Stage("3.1.2/github_repos_extraction.py", github_repos_extraction.create_repos_and_files_names_csv,
+              inputs=["data/IST_MIR.csv", "data/IST_MOZ.csv", "data/IST_OST.csv", "data/IST_WIK.csv"],
+              outputs=["3.1.2/results/IaC_repos.csv", "3.1.2/results/IaC_files.csv"]),
+        script_stage("3.1.2/xcm_generator.py", [],
+                     inputs=["3.1.2/results/IaC_repos.csv"], outputs=["3.1.2/results/XCM_list.csv"])
     ]
 
-    for script_name in scripts:
-        print(f"Running {script_name}...")
-        if not run_script(script_name):
-            print(f"Process halted due to error in {script_name}")
-            sys.exit(1)
-        print()
-        time.sleep(5)  
+    failed = run_stages(stages)
+    if failed:
+        print(f"Process halted due to error in {failed[0]}")
+        sys.exit(1)
 
-    print("Process completed successfully.")
\ No newline at end of file
+    print("Process completed successfully.")
@@ -1,23 +1,147 @@
 import requests
 import os
+import sqlite3
+import threading
+import time
 import regex as re
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 # Load environment variables from a .env file if present
 load_dotenv()
 
+BUGZILLA_URL = "https://bugzilla.mozilla.org"
+LAUNCHPAD_URL = "https://api.launchpad.net"
+PHABRICATOR_URL = "https://phabricator.wikimedia.org"
+
+# Issue tracker used by each organization
+ORG_TRACKERS = {
+    "Mirantis": "launchpad",
+    "mozilla": "bugzilla",
+    "openstack": "launchpad",
+    "wikimedia": "phabricator"
+}
+
+# Persistent cache of the issues already fetched, next to this file whatever the working directory
+ISSUES_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "issues.sqlite")
+# Number of issues requested in a single call to the bulk endpoints
+ISSUES_PER_REQUEST = 100
+# Number of concurrent calls to trackers without bulk endpoint (Launchpad)
+TRACKER_WORKERS = 8
+
+
+class TrackerError(Exception):
+    """
+    A call to an issue tracker failed: the issues it asked for are unknown, not missing.
+    issues holds the ones fetched by the calls that succeeded before.
+    """
+    def __init__(self, message, issues=None):
+        super().__init__(message)
+        self.issues = issues or {}
+
+
+def get_issues_bugzilla(issue_ids, session=requests):
+    """
+    Fetch issue summaries from Bugzilla, ISSUES_PER_REQUEST issues per call.
+    Note: issue_ids should be 7-digit numbers (e.g., '1234567')
+    Returns a dictionary issue_id -> summary, None for the issues that do not exist or are private,
+    raises TrackerError if a call fails.
+    """
+    issues = {}
+    for i in range(0, len(issue_ids), ISSUES_PER_REQUEST):
+        chunk = issue_ids[i:i + ISSUES_PER_REQUEST]
+        url = f"{BUGZILLA_URL}/rest/bug"
+        # permissive: bugs that do not exist or are private are left out instead of failing the whole call
+        params = {"id": ",".join(chunk), "include_fields": "id,summary", "permissive": 1}
+        response = session.get(url, params=params)
+        if response.status_code == 200:
+            data = response.json()
+            # Bugs left out of a successful call are confirmed missing
+            issues.update(dict.fromkeys(chunk))
+            for bug in data["bugs"]:
+                issues[str(bug["id"])] = bug["summary"]
+        else:
+            raise TrackerError(f"Bugzilla call failed: {response.status_code} - {response.text}", issues)
+    return issues
+
+
+def get_issues_launchpad(issue_ids, session=requests, max_workers=TRACKER_WORKERS):
+    """
+    Fetch issue details from Launchpad, which has no bulk endpoint: calls are made concurrently.
+    Note: issue_ids should start with '#' (e.g., '#1234567')
+    Returns a dictionary issue_id -> description, None for the issues that do not exist,
+    raises TrackerError if a call fails.
+    """
+    def get_description(issue_id):
+        url = f"{LAUNCHPAD_URL}/devel/bugs/{issue_id[1:]}"
+        response = session.get(url)
+        if response.status_code == 200:
+            data = response.json()
+            return data["description"]
+        elif response.status_code != 404:
+            raise TrackerError(f"Launchpad call failed: {response.status_code} - {response.text}")
+
+    issues = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {issue_id: executor.submit(get_description, issue_id) for issue_id in issue_ids}
+        for issue_id, future in futures.items():
+            try:
+                description = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            issues[issue_id] = description
+
+    if errors:
+        raise TrackerError(f"{len(errors)} Launchpad calls failed, the first one: {errors[0]}", issues)
+    return issues
+
+
+def get_issues_phabricator(issue_ids, session=requests):
+    """
+    Fetch issue details from Phabricator, ISSUES_PER_REQUEST issues per call.
+    Note: issue_ids should start with 'T' (e.g., 'T12345')
+    Returns a dictionary issue_id -> description, None for the issues that do not exist or are private,
+    raises TrackerError if a call fails.
+    """
+    url = f"{PHABRICATOR_URL}/api/maniphest.search"
+    token = os.getenv("PHABRICATOR_TOKEN")
+    headers = {
+        "user-agent": "MyPhabBot/1.0"
+    }
+    issues = {}
+    for i in range(0, len(issue_ids), ISSUES_PER_REQUEST):
+        chunk = issue_ids[i:i + ISSUES_PER_REQUEST]
+        payload = {
+            "api.token": token,
+            "limit": ISSUES_PER_REQUEST
+        }
+        for j, issue_id in enumerate(chunk):
+            payload[f"constraints[ids][{j}]"] = int(issue_id[1:])
+        response = session.post(url, headers=headers, data=payload)
+        if response.status_code != 200:
+            raise TrackerError(f"Phabricator call failed: {response.status_code} - {response.text}", issues)
+        data = response.json()
+        # Conduit reports its errors in a successful response
+        if data.get('error_code'):
+            raise TrackerError(f"Phabricator call failed: {data['error_code']} - {data.get('error_info')}", issues)
+        # Tasks left out of a successful call are confirmed missing
+        issues.update(dict.fromkeys(chunk))
+        if data['result'] and data['result']['data']:
+            for task in data['result']['data']:
+                issues[f"T{task['id']}"] = task['fields']['description']['raw']
+    return issues
+
+
 def get_issue_bugzilla(issue_id):
     """
     Fetch issue details from Bugzilla using the provided issue ID.  
     Note: issue_id should be a 7-digit number (e.g., '1234567')  
     """
-    url = f"https://bugzilla.mozilla.org/rest/bug/{issue_id}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        return data["bugs"][0]["summary"]
-    else:
-        print(f"Error - Failed to make API call for issue tracking: {response.status_code} - {response.text}")
+    return get_issues_bugzilla([issue_id]).get(issue_id)
 
 
 def get_issue_launchpad(issue_id):
@@ -25,13 +149,7 @@ def get_issue_launchpad(issue_id):
     Fetch issue details from Launchpad using the provided issue ID.
     Note: issue_id should start with '#' (e.g., '#1234567')
     """
-    url = f"https://api.launchpad.net/devel/bugs/{issue_id[1:]}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        return data["description"]
-    else:
-        print(f"Error - Failed to make API call for issue tracking: {response.status_code} - {response.text}")
+    return get_issues_launchpad([issue_id]).get(issue_id)
 
 
 def get_issue_phabricator(issue_id):
@@ -39,38 +157,197 @@ def get_issue_phabricator(issue_id):
     Fetch issue details from Phabricator using the provided issue ID.
     Note: issue_id should start with 'T' (e.g., 'T12345')
     """
-    url = "https://phabricator.wikimedia.org/api/maniphest.search"
-    token = os.getenv("PHABRICATOR_TOKEN")
-    headers = {
-        "user-agent": "MyPhabBot/1.0"
-    }
-    payload = {
-        "api.token": token,
-        "constraints[ids][0]": int(issue_id[1:])
-    }
-    response = requests.post(url, headers=headers, data=payload)
-    if response.status_code == 200:
-        data = response.json()
-        if data['result']['data']:
-            return data['result']['data'][0]['fields']['description']['raw']
-    else:
-        print(f"Error - Failed to make API call for issue tracking: {response.status_code} - {response.text}")
+    return get_issues_phabricator([issue_id]).get(issue_id)
+
+
+TRACKER_FETCHERS = {
+    "bugzilla": get_issues_bugzilla,
+    "launchpad": get_issues_launchpad,
+    "phabricator": get_issues_phabricator
+}
+
+
+class HostLimitedSession(requests.Session):
+    """
+    Session allowing at most max_per_host requests in flight to each host.
+    """
+    def __init__(self, max_per_host=TRACKER_WORKERS):
+        super().__init__()
+        self._slots_lock = threading.Lock()
+        self.set_max_per_host(max_per_host)
+
+    def set_max_per_host(self, max_per_host):
+        with self._slots_lock:
+            self.max_per_host = max_per_host
+            self._slots = {}
+        adapter = HTTPAdapter(pool_maxsize=max_per_host)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlparse(url).netloc
+        with self._slots_lock:
+            slot = self._slots.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+        with slot:
+            return super().request(method, url, *args, **kwargs)
+
+
+class IssueTrackerClient:
+    """
+    Issue lookups shared by the whole run: every issue is fetched at most once, from a persistent
+    cache first and then through the bulk endpoint of its tracker. Issues the tracker reported
+    missing are cached too, with a NULL summary, so they are not asked for again.
+    Concurrent lookups of the same issue wait for the same request.
+    The cache is only opened by the first lookup, importing the module creates no file.
+    """
+    def __init__(self, cache_path=ISSUES_CACHE_PATH, max_per_host=TRACKER_WORKERS):
+        self.session = HostLimitedSession(max_per_host)
+        self._lock = threading.Lock()
+        self._issues = {}
+
+        self.cache_path = cache_path
+        self._db_lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        # Called with _db_lock held
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            self._db = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS issues ("
+                " tracker TEXT NOT NULL, issue_id TEXT NOT NULL, summary TEXT, fetched_at REAL NOT NULL,"
+                " PRIMARY KEY (tracker, issue_id))"
+            )
+            self._db.commit()
+        return self._db
+
+    def _load_cached(self, tracker, issue_ids):
+        issues = {}
+        with self._db_lock:
+            db = self._connect()
+            for i in range(0, len(issue_ids), 500):
+                chunk = issue_ids[i:i + 500]
+                rows = db.execute(
+                    f"SELECT issue_id, summary FROM issues WHERE tracker = ? AND issue_id IN ({','.join('?' * len(chunk))})",
+                    [tracker, *chunk]
+                ).fetchall()
+                issues.update(rows)
+        return issues
+
+    def _store(self, tracker, issues):
+        with self._db_lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO issues (tracker, issue_id, summary, fetched_at) VALUES (?, ?, ?, ?)",
+                [(tracker, issue_id, summary, time.time()) for issue_id, summary in issues.items()]
+            )
+            db.commit()
+
+    def lookup_issues(self, org_name, issue_ids):
+        """
+        Fetch the details of several issues of an organization at once.
+        Returns a dictionary issue_id -> summary (None when the issue does not exist) of the issues
+        looked up, and the set of the issues whose lookup failed. Failed lookups are not kept:
+        the next lookup of these issues calls the tracker again.
+        """
+        tracker = ORG_TRACKERS.get(org_name)
+        if tracker is None:
+            return {issue_id: None for issue_id in issue_ids}, set()
+
+        # Register the issues nobody asked for yet, the others are already fetched or being fetched
+        futures = {}
+        to_fetch = []
+        with self._lock:
+            for issue_id in dict.fromkeys(issue_ids):
+                key = (tracker, issue_id)
+                if key not in self._issues:
+                    self._issues[key] = Future()
+                    to_fetch.append(issue_id)
+                futures[issue_id] = self._issues[key]
+
+        if to_fetch:
+            fetched = {}
+            # Only cleared once the lookup went through
+            error = TrackerError(f"Lookup of {tracker} issues interrupted")
+            try:
+                fetched = self._load_cached(tracker, to_fetch)
+                missing = [issue_id for issue_id in to_fetch if issue_id not in fetched]
+                fetch_error = None
+                if missing:
+                    try:
+                        # Summaries of the issues found, None for the ones the tracker confirmed missing
+                        new_issues = TRACKER_FETCHERS[tracker](missing, session=self.session)
+                    except TrackerError as e:
+                        # The issues fetched before the failure are still kept
+                        new_issues, fetch_error = e.issues, e
+                    self._store(tracker, new_issues)
+                    fetched.update(new_issues)
+                error = fetch_error
+            except Exception as e:
+                error = e
+            finally:
+                if error is not None:
+                    print(f"Error - Failed to fetch issues from {tracker}: {error}")
+                with self._lock:
+                    for issue_id in to_fetch:
+                        if issue_id in fetched or error is None:
+                            futures[issue_id].set_result(fetched.get(issue_id))
+                        else:
+                            # Without the error, a missing issue would look like an issue without summary
+                            del self._issues[(tracker, issue_id)]
+                            futures[issue_id].set_exception(error)
+
+        issues = {}
+        failed = set()
+        for issue_id, future in futures.items():
+            if future.exception() is None:
+                issues[issue_id] = future.result()
+            else:
+                failed.add(issue_id)
+        return issues, failed
+
+    def get_issues(self, org_name, issue_ids):
+        """
+        Fetch the details of several issues of an organization at once.
+        Returns a dictionary issue_id -> summary (None when the issue does not exist),
+        raises TrackerError if some of them could not be fetched.
+        """
+        issues, failed = self.lookup_issues(org_name, issue_ids)
+        if failed:
+            raise TrackerError(f"{len(failed)} issues of {org_name} could not be fetched", issues)
+        return issues
+
+
+tracker_client = IssueTrackerClient()
 
 
 def get_issue(org_name, issue_id):
     """
     Fetch issue details based on the organization name and issue ID.
     """
-    if org_name == "Mirantis":
-        return get_issue_launchpad(issue_id)
-    elif org_name == "mozilla":
-        return get_issue_bugzilla(issue_id)
-    elif org_name == "openstack":
-        return get_issue_launchpad(issue_id)
-    elif org_name == "wikimedia":
-        return get_issue_phabricator(issue_id)
-    else:
-        return None
+    return tracker_client.get_issues(org_name, [issue_id])[issue_id]
+
+
+def set_tracker_concurrency(max_per_host):
+    """
+    Set the number of concurrent calls allowed to each issue tracker host.
+    """
+    tracker_client.session.set_max_per_host(max_per_host)
+
+
+def get_issues(org_name, issue_ids):
+    """
+    Fetch the details of many issues of an organization, de-duplicated, cached and in bulk.
+    """
+    return tracker_client.get_issues(org_name, issue_ids)
+
+
+def lookup_issues(org_name, issue_ids):
+    """
+    Like get_issues, but returns the issues looked up and the set of the ones that failed instead of raising.
+    """
+    return tracker_client.lookup_issues(org_name, issue_ids)
 
 def get_issue_tags_mirantis(commit_message):
     """
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+
+# Next to this file whatever the working directory, like the other caches
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "xcm_checkpoint.sqlite")
+
+class XCMCheckpoint:
+    """
+    Progress of an XCM generation run: the commits already processed for each (org, repo),
+    the head commit of every repository completed, and the size of the output file
+    after the last chunk that was fully written.
+    """
+    def __init__(self, path=CHECKPOINT_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS processed_commits ("
+            " org_name TEXT NOT NULL, repo_name TEXT NOT NULL, commit_sha TEXT NOT NULL,"
+            " PRIMARY KEY (org_name, repo_name, commit_sha))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completed_repos ("
+            " org_name TEXT NOT NULL, repo_name TEXT NOT NULL, head_sha TEXT,"
+            " PRIMARY KEY (org_name, repo_name))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS output (id INTEGER PRIMARY KEY CHECK (id = 0),"
+            " rows_written INTEGER NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.execute("INSERT OR IGNORE INTO output (id, rows_written, size) VALUES (0, 0, 0)")
+        self._db.commit()
+
+    def reset(self):
+        self._db.execute("DELETE FROM processed_commits")
+        self._db.execute("DELETE FROM completed_repos")
+        self._db.execute("UPDATE output SET rows_written = 0, size = 0")
+        self._db.commit()
+
+    def processed_commits(self, org_name, repo_name):
+        rows = self._db.execute(
+            "SELECT commit_sha FROM processed_commits WHERE org_name = ? AND repo_name = ?",
+            (org_name, repo_name)
+        ).fetchall()
+        return {sha for (sha,) in rows}
+
+    def head_sha(self, org_name, repo_name):
+        # Newest commit of the repository when it was last completed, None if it never was
+        row = self._db.execute(
+            "SELECT head_sha FROM completed_repos WHERE org_name = ? AND repo_name = ?",
+            (org_name, repo_name)
+        ).fetchone()
+        return row[0] if row else None
+
+    def output_state(self):
+        # (rows written, output file size in bytes) after the last committed chunk
+        return self._db.execute("SELECT rows_written, size FROM output").fetchone()
+
+    def commit_chunk(self, org_name, repo_name, commit_shas, nb_rows, size):
+        # Called once the rows of a chunk are on disk: the chunk is then never processed again
+        self._db.executemany(
+            "INSERT OR IGNORE INTO processed_commits (org_name, repo_name, commit_sha) VALUES (?, ?, ?)",
+            [(org_name, repo_name, sha) for sha in commit_shas]
+        )
+        self._db.execute("UPDATE output SET rows_written = rows_written + ?, size = ?", (nb_rows, size))
+        self._db.commit()
+
+    def complete_repo(self, org_name, repo_name, head_sha):
+        self._db.execute(
+            "INSERT OR REPLACE INTO completed_repos (org_name, repo_name, head_sha) VALUES (?, ?, ?)",
+            (org_name, repo_name, head_sha)
+        )
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
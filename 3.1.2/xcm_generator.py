@@ -1,61 +1,291 @@
 import pandas as pd
 from dotenv import load_dotenv
 import os
+import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Implemented functions
-from github_commit_extraction import repo_commits_extraction, files_from_commit_extraction
-from tracker_issue_mining import get_issue_tags, get_issue
+from github_commit_extraction import iter_repo_commits, files_from_commits_extraction, repo_commits_and_files_graphql_extraction, TruncatedTreeError
+from git_commit_extraction import iter_repo_commits_and_files
+from tracker_issue_mining import get_issue_tags, lookup_issues, set_tracker_concurrency
+from xcm_checkpoint import XCMCheckpoint
 
 # Load environment variables from a .env file if present
 load_dotenv()
 
-def xcm_gnerator():
+GITHUB_REPOS_URL = "https://api.github.com/repos/"
+COMMIT_FILES_COLUMNS = ['org_name', 'repo_name', 'file_name', 'commit_message', 'commit_sha', 'issue_id']
+XCM_COLUMNS = COMMIT_FILES_COLUMNS + ['summary_issue', 'XCM']
+XCM_OUTPUT = "3.1.2/results/XCM_list.csv"
+# Repositories mined at the same time in each organization
+WORKERS_PER_ORG = 4
+# Concurrent calls allowed to each issue tracker host
+TRACKER_CONCURRENCY = 8
+# Mined chunks of a repository waiting to be written, its miner pauses when they are all taken
+CHUNKS_PER_REPO = 2
+
+def commit_batches(org_name, org_url, repo_name, backend, skip_shas=(), stop_sha=None):
    """
-   Generate the extended commit messages (XCM) linking IaC files commit messages to issues summary.
+   Yield the commits of a repository in batches, each with the IaC files changed by every commit
+   and the newest commit of the batch before filtering.
+   Commits in skip_shas are left out, and the REST history is only read down to stop_sha.
+   With the GraphQL backend, a repository whose tree is too large to be listed is mined with the REST backend.
    """
-   # Loading source and preparing results dataframe
-   source_repo_df = pd.read_csv("3.1.2/results/IaC_repos.csv")
-   result_df = pd.DataFrame(columns = ['org_name', 'repo_name', 'file_name', 'commit_message', 'commit_sha', 'issue_id', 'summary_issue', 'XCM'])
+   if backend == "git":
+      #Call the function to read commits and their IaC files from a local clone (no API calls)
+      for repo_commits, files_from_commits in iter_repo_commits_and_files(org_name, repo_name):
+         yield skip_commits(repo_commits, files_from_commits, skip_shas)
+   elif backend == "graphql":
+      #Call the function to extract commits and their IaC files in batched GraphQL queries
+      try:
+         repo_commits, files_from_commits = repo_commits_and_files_graphql_extraction(org_url, repo_name)
+      except TruncatedTreeError as e:
+         #Its IaC files cannot all be followed, the REST history gives all its commits
+         print(f"{e}, mining it with the REST backend")
+         yield from commit_batches(org_name, org_url, repo_name, "rest", skip_shas, stop_sha)
+         return
+      if repo_commits is not None:
+         yield skip_commits(repo_commits, files_from_commits, skip_shas)
+   else:
+      #Call the function to stream the whole commit history of the current repository
+      for repo_commits in iter_repo_commits(org_url, repo_name):
+         newest_sha = repo_commits['commit_sha'].iloc[0]
+         reached_stop = stop_sha is not None and (repo_commits['commit_sha'] == stop_sha).any()
+         if reached_stop:
+            #Commits older than the last completed run were all processed already
+            repo_commits = repo_commits.iloc[:repo_commits.index[repo_commits['commit_sha'] == stop_sha][0]]
 
-   # Configuration for API calls
-   base_url = "https://api.github.com/repos/"
-   org_names = ["Mirantis", "mozilla", "openstack", "wikimedia"]
+         repo_commits = repo_commits[~repo_commits['commit_sha'].isin(skip_shas)].reset_index(drop=True)
+         #Call the function to extract IaC files from all the commits of the batch at once (requests run in parallel)
+         yield repo_commits, files_from_commits_extraction(org_url, repo_name, repo_commits['commit_sha']), newest_sha
+
+         if reached_stop:
+            return
+
+def skip_commits(repo_commits, files_from_commits, skip_shas):
+   newest_sha = repo_commits['commit_sha'].iloc[0] if len(repo_commits) else None
+   keep = ~repo_commits['commit_sha'].isin(skip_shas)
+   return repo_commits[keep].reset_index(drop=True), [files for files, kept in zip(files_from_commits, keep) if kept], newest_sha
+
+def collect_commit_files(org_name, repo_name, repo_commits, files_from_commits, buffer):
+   """
+   Stage 1: append one (org, repo, file, commit, issue_id) entry per IaC file changed by each commit
+   of a batch to the columnar buffer. No issue tracker is called at this stage.
+   """
+   for commit_message, commit_sha, files_from_commit in zip(repo_commits['commit_message'], repo_commits['commit_sha'], files_from_commits):
+      if files_from_commit is None:
+         continue
+
+      #Extract issue tags from the commit message, once for all its files
+      issue_id = get_issue_tags(org_name, commit_message)
+
+      for file_name in files_from_commit['file_name']:
+         buffer['org_name'].append(org_name)
+         buffer['repo_name'].append(repo_name)
+         buffer['file_name'].append(file_name)
+         buffer['commit_message'].append(commit_message)
+         buffer['commit_sha'].append(commit_sha)
+         buffer['issue_id'].append(issue_id)
+
+def resolve_issues(commit_files_df):
+   """
+   Stage 2: fetch the summary of every distinct issue, each organization's tracker being queried concurrently.
+   Returns a dataframe with the org_name, issue_id and summary_issue columns, and the set of the
+   (org_name, issue_id) whose lookup failed.
+   """
+   issues_df = commit_files_df[['org_name', 'issue_id']].dropna().drop_duplicates()
+   issue_ids_by_org = issues_df.groupby('org_name')['issue_id'].apply(list)
+
+   summaries = {'org_name': [], 'issue_id': [], 'summary_issue': []}
+   failed = set()
+   with ThreadPoolExecutor(max_workers=max(1, len(issue_ids_by_org))) as executor:
+      futures = {org_name: executor.submit(lookup_issues, org_name, issue_ids) for org_name, issue_ids in issue_ids_by_org.items()}
+      for org_name, future in futures.items():
+         issues, failed_ids = future.result()
+         for issue_id, summary_issue in issues.items():
+            summaries['org_name'].append(org_name)
+            summaries['issue_id'].append(issue_id)
+            summaries['summary_issue'].append(summary_issue)
+         failed.update((org_name, issue_id) for issue_id in failed_ids)
+
+   return pd.DataFrame(summaries), failed
+
+def build_xcm(commit_files_df, issues_df):
+   """
+   Stage 3: join the commits with the issue summaries and construct all the XCM at once.
+   """
+   result_df = commit_files_df.merge(issues_df, on=['org_name', 'issue_id'], how='left')
+
+   #Construct the XCM
+   issue_text = result_df['issue_id'].where(result_df['issue_id'].notna() & (result_df['issue_id'] != ''), 'No Issue')
+   summary_text = result_df['summary_issue'].where(result_df['summary_issue'].notna() & (result_df['summary_issue'] != ''), 'No Summary')
+   result_df['XCM'] = (result_df['file_name'].astype(str) + " | " + result_df['commit_message'].astype(str) + " | "
+                       + issue_text.astype(str) + " | " + summary_text.astype(str))
+
+   return result_df[XCM_COLUMNS]
 
-   for org_name in org_names:
-      # Iterate through each repository in the current organization
-      print(f"Processing organization: {org_name}")
-      org_url = f"{base_url}{org_name}/"
+def append_xcm(result_df, checkpoint, org_name, repo_name, commit_shas):
+   """
+   Append a chunk of XCM to the output file, then record its commits as processed.
+   """
+   rows_written, _ = checkpoint.output_state()
+   result_df.index = range(rows_written, rows_written + len(result_df))
+
+   with open(XCM_OUTPUT, 'a', newline='', encoding='utf-8') as f:
+      result_df.to_csv(f, header=(rows_written == 0 and f.tell() == 0))
+      f.flush()
+      os.fsync(f.fileno())
+      size = f.tell()
+
+   checkpoint.commit_chunk(org_name, repo_name, commit_shas, len(result_df), size)
+
+def put_chunk(chunks, item, stopped):
+   # Wait for room in the bounded queue of the repository, False if the run stopped meanwhile
+   while not stopped.is_set():
+      try:
+         chunks.put(item, timeout=1)
+         return True
+      except queue.Full:
+         pass
+   return False
+
+def mine_repository(org_name, repo_name, backend, skip_shas, stop_sha, chunks, stopped):
+   """
+   Generate the XCM of the commits of a repository not processed yet, batch after batch.
+   Every batch is put on the chunks queue as ("chunk", result_df, commit_shas), followed by ("done", head_sha)
+   once the repository is complete, or ("error", exception) if mining failed.
+   The queue is bounded: mining waits while the writer is busy with previous repositories, so only
+   a few chunks per repository are ever held in memory without being checkpointed.
+   Mining is abandoned once stopped is set.
+   Commits whose changed files or issue could not be fetched are left out of the chunks and of the
+   checkpoint, and the repository is then done without head commit, so a resumed run mines them again.
+   """
+   try:
+      head_sha = None
+      incomplete = False
+      for repo_commits, files_from_commits, newest_sha in commit_batches(org_name, f"{GITHUB_REPOS_URL}{org_name}/", repo_name, backend, skip_shas, stop_sha):
+         if head_sha is None:
+            head_sha = newest_sha
+         if not len(repo_commits):
+            continue
+
+         # Stage 1: commits and IaC files of the batch, in a columnar buffer
+         buffer = {column: [] for column in COMMIT_FILES_COLUMNS}
+         collect_commit_files(org_name, repo_name, repo_commits, files_from_commits, buffer)
+         commit_files_df = pd.DataFrame(buffer, columns=COMMIT_FILES_COLUMNS)
+
+         # Commits whose changed files could not be fetched got no rows, they are not processed yet
+         commit_shas = [sha for sha, files in zip(repo_commits['commit_sha'], files_from_commits) if files is not None]
+         if len(commit_shas) < len(repo_commits):
+            print(f"{len(repo_commits) - len(commit_shas)} commits of {org_name}/{repo_name} left for a resumed run, their files could not be fetched")
+            incomplete = True
+
+         # Stage 2: every distinct issue of the batch resolved in bulk
+         issues_df, failed_issues = resolve_issues(commit_files_df)
+         if failed_issues:
+            failed = commit_files_df['issue_id'].isin({issue_id for _, issue_id in failed_issues})
+            failed_shas = set(commit_files_df.loc[failed, 'commit_sha'])
+            print(f"{len(failed_shas)} commits of {org_name}/{repo_name} left for a resumed run, their issue could not be fetched")
+            commit_files_df = commit_files_df[~commit_files_df['commit_sha'].isin(failed_shas)].reset_index(drop=True)
+            commit_shas = [sha for sha in commit_shas if sha not in failed_shas]
+            incomplete = True
 
-      for repo_name in source_repo_df[f'{org_name}']:
-         if not pd.isna(repo_name):
+         # Stage 3: single join building all the XCM of the batch
+         result_df = build_xcm(commit_files_df, issues_df)
+         if not put_chunk(chunks, ("chunk", result_df, commit_shas), stopped):
+            return
+
+      put_chunk(chunks, ("done", None if incomplete else head_sha or stop_sha), stopped)
+   except Exception as e:
+      put_chunk(chunks, ("error", e), stopped)
+
+def write_repository(org_name, repo_name, chunks, checkpoint):
+   """
+   Append the XCM chunks of a repository to the output as they are mined, recording the progress.
+   """
+   while True:
+      kind, *payload = chunks.get()
+      if kind == "chunk":
+         result_df, commit_shas = payload
+         append_xcm(result_df, checkpoint, org_name, repo_name, commit_shas)
+      elif kind == "done":
+         checkpoint.complete_repo(org_name, repo_name, payload[0])
+         return
+      else:
+         raise payload[0]
+
+def xcm_gnerator(backend="rest", resume=False, workers_per_org=WORKERS_PER_ORG, tracker_concurrency=TRACKER_CONCURRENCY):
+   """
+   Generate the extended commit messages (XCM) linking IaC files commit messages to issues summary.
+   backend selects how commits and their files are mined: "rest" (one call per commit), "graphql" (batched)
+   or "git" (local clones, no API calls).
+   With resume, commits processed by a previous (interrupted or complete) run are skipped
+   and only the new XCM are appended to the output.
+   Up to workers_per_org repositories of every organization are mined at the same time and at most
+   tracker_concurrency calls are made to each issue tracker host. The output keeps the order of the
+   source repositories whatever order they complete in.
+   """
+   # Loading source
+   source_repo_df = pd.read_csv("3.1.2/results/IaC_repos.csv")
+   org_names = ["Mirantis", "mozilla", "openstack", "wikimedia"]
+   repos = [(org_name, repo_name) for org_name in org_names for repo_name in source_repo_df[f'{org_name}'] if not pd.isna(repo_name)]
 
-            #Call the function to extract commits for the current repository
-            repo_commits = repo_commits_extraction(org_url, repo_name)
-            
-            if repo_commits is not None:
-               for _, row in repo_commits.iterrows():
-                    commit_message = row['commit_message']
-                    commit_sha = row['commit_sha']
-    
-                    #Call the function to extract IaC files from the current commit
-                    files_from_commit = files_from_commit_extraction(org_url, repo_name, commit_sha)
-    
+   set_tracker_concurrency(tracker_concurrency)
 
-                    for _, file_row in files_from_commit.iterrows():
-                        file_name = file_row['file_name']
+   checkpoint = XCMCheckpoint()
+   if resume and os.path.exists(XCM_OUTPUT):
+      # Drop any partial chunk written after the last checkpoint
+      _, size = checkpoint.output_state()
+      os.truncate(XCM_OUTPUT, size)
+   else:
+      checkpoint.reset()
+      open(XCM_OUTPUT, 'w').close()
 
-                        #Extract issue tags from the commit message
-                        issue_id = get_issue_tags(org_name, commit_message)
+   # One pool per organization, so a large organization does not hold back the others
+   executors = {org_name: ThreadPoolExecutor(max_workers=workers_per_org) for org_name in org_names}
+   # Set when the writer stops, so miners waiting for room in their queue give up
+   stopped = threading.Event()
+   try:
+      repos_chunks = []
+      for org_name, repo_name in repos:
+         # Repositories start in source order in their pool, the one being written is always mined
+         chunks = queue.Queue(maxsize=CHUNKS_PER_REPO)
+         executors[org_name].submit(mine_repository, org_name, repo_name, backend,
+                                    checkpoint.processed_commits(org_name, repo_name),
+                                    checkpoint.head_sha(org_name, repo_name), chunks, stopped)
+         repos_chunks.append(chunks)
 
-                        #Fetch issue summary if an issue ID was found
-                        summary_issue = get_issue(org_name, issue_id) if issue_id else None
+      # Repositories are written in source order, which keeps the output deterministic
+      current_org = None
+      for (org_name, repo_name), chunks in zip(repos, repos_chunks):
+         if org_name != current_org:
+            print(f"Processing organization: {org_name}")
+            current_org = org_name
+         write_repository(org_name, repo_name, chunks, checkpoint)
+   finally:
+      stopped.set()
+      for executor in executors.values():
+         executor.shutdown(wait=True, cancel_futures=True)
+      checkpoint.close()
 
-                        #Construct the XCM
-                        xcm = f"{file_name} | {commit_message} | {issue_id if issue_id else 'No Issue'} | {summary_issue if summary_issue else 'No Summary'}"
+   # Header only output when no XCM was generated
+   if os.path.getsize(XCM_OUTPUT) == 0:
+      pd.DataFrame(columns=XCM_COLUMNS).to_csv(XCM_OUTPUT)
 
-                        #Append the result to the dataframe
-                        result_df.loc[len(result_df)] = [org_name, repo_name, file_name, commit_message, commit_sha, issue_id, summary_issue, xcm]
-   result_df.to_csv("3.1.2/results/XCM_list.csv")
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Generate the extended commit messages (XCM)")
+   parser.add_argument("--backend", choices=["rest", "graphql", "git"], default="rest",
+                       help="Source used to mine commits and changed files (default: rest)")
+   parser.add_argument("--resume", action="store_true",
+                       help="Skip the commits already processed by a previous run and append the new XCM")
+   parser.add_argument("--workers-per-org", type=int, default=WORKERS_PER_ORG,
+                       help=f"Repositories mined at the same time in each organization (default: {WORKERS_PER_ORG})")
+   parser.add_argument("--tracker-concurrency", type=int, default=TRACKER_CONCURRENCY,
+                       help=f"Concurrent calls allowed to each issue tracker host (default: {TRACKER_CONCURRENCY})")
+   args = parser.parse_args(argv)
+   xcm_gnerator(args.backend, args.resume, args.workers_per_org, args.tracker_concurrency)
 
 if __name__ == "__main__":
-    xcm_gnerator()
\ No newline at end of file
+   main()